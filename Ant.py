@@ -3,8 +3,7 @@ from World import *
 
 import numpy as np
 
-import yaml
-config = yaml.load(open("config.yml"))
+from Config import config
 
 
 class Ant(WorldObject):
@@ -12,28 +11,38 @@ class Ant(WorldObject):
     class Ant inherits from WorldObject and additionally holds a direction vector ...
     '''
 
-    # speed per second
-    max_speed = config["ant"]["max_speed"]
-    min_speed = config["ant"]["min_speed"]
-    max_turn_angle = config["ant"]["max_turn_angle"]
-    acceleration = config["ant"]["acceleration"]
-
-    length = config["ant"]["length"]
-    center_radius = config["ant"]["center_radius"]
-    head_radius = config["ant"]["head_radius"]
-    head_angle = config["ant"]["head_angle"]
-
-    signal_noise = config["ant"]["angle_noise_error"]
-
-    phero_speed_down_treshold = config["ant"]["phero_speed_down_treshold"]
-
-    def __init__(self, position, direction, world_instance = None):
+    def __init__(self, position, direction, world_instance = None, config = config):
         WorldObject.__init__(self, position, world_instance)
         self.set_type("ant")
 
+        self.set_parameters(config["ant"])
+
         #norm the direction to 1
         self.direction = norm_vector(np.array(direction))
-        self.speed = Ant.min_speed
+        self.speed = self.min_speed
+
+    def set_parameters(self, ant_config):
+        # speed per second
+        self.max_speed = ant_config["max_speed"]
+        self.min_speed = ant_config["min_speed"]
+        self.max_turn_angle = ant_config["max_turn_angle"]
+        self.acceleration = ant_config["acceleration"]
+
+        self.length = ant_config["length"]
+        self.center_radius = ant_config["center_radius"]
+        self.head_radius = ant_config["head_radius"]
+        self.head_angle = ant_config["head_angle"]
+
+        self.signal_noise = ant_config["angle_noise_error"]
+
+        self.phero_speed_down_treshold = ant_config["phero_speed_down_treshold"]
+
+        # how the antennas read the pheromone map: nearest, bilinear or disk
+        self.antenna_sampling = ant_config.get("antenna_sampling", "nearest")
+
+        # pheromone channels the ant follows and lays, None for the first one
+        self.sense_channel = ant_config.get("sense_channel")
+        self.deposit_channel = ant_config.get("deposit_channel")
 
     def to_dict(self):
         d = {}
@@ -45,11 +54,11 @@ class Ant(WorldObject):
 
     def get_left_antenna_position(self):
         pos_head = self.get_head_position()
-        return pos_head + rotate_vector(self.direction * Ant.head_radius, Ant.head_angle / 2)
+        return pos_head + rotate_vector(self.direction * self.head_radius, self.head_angle / 2)
 
     def get_right_antenna_position(self):
         pos_head = self.get_head_position()
-        return pos_head + rotate_vector(self.direction * Ant.head_radius, 360 - Ant.head_angle / 2)
+        return pos_head + rotate_vector(self.direction * self.head_radius, 360 - self.head_angle / 2)
 
     def get_head_position(self):
         return self.position + self.direction * (self.length / 2)
@@ -71,8 +80,8 @@ class Ant(WorldObject):
         o_turn_angle, turn_angle, orientation = get_oriented_angle(self.direction, self.direction + collision_vector)
 
         #check if angle exceeds max angle
-        if turn_angle > Ant.max_turn_angle * delta:
-            o_turn_angle = Ant.max_turn_angle * orientation * delta
+        if turn_angle > self.max_turn_angle * delta:
+            o_turn_angle = self.max_turn_angle * orientation * delta
 
         #rotate the vector
         new_direction = rotate_vector(self.direction, o_turn_angle)
@@ -82,8 +91,8 @@ class Ant(WorldObject):
     def evade_objects(self, delta):
         #this is the main collision method
 
-        pos_in_center_range = self.world.get_positions_in_range_kd(self.position, self.center_radius)
-        pos_in_top_range = self.world.get_positions_in_range_and_radius_kd(self.position, self.direction, Ant.head_radius, Ant.head_angle)
+        pos_in_center_range = self.world.get_positions_in_range_kd(self.position, self.center_radius, self.index)
+        pos_in_top_range = self.world.get_positions_in_range_and_radius_kd(self.position, self.direction, self.head_radius, self.head_angle, self.index)
 
         if pos_in_center_range.size == 0 and pos_in_top_range.size == 0:
             return
@@ -103,15 +112,13 @@ class Ant(WorldObject):
 
         return False
 
-    def trail_pheromone(self, delta):
+    def trail_pheromone(self, delta, noise):
         # turns the ant to the side with higher pheromone concentration
 
-        pos_left = self.get_left_antenna_position()
-        pos_right = self.get_right_antenna_position()
+        antennas = np.array([self.get_left_antenna_position(), self.get_right_antenna_position()], dtype=np.float)
 
         # concentrations
-        c_left = self.world.phero_map.get_pheromone_concentration(pos_left, Ant.head_radius)
-        c_right = self.world.phero_map.get_pheromone_concentration(pos_right, Ant.head_radius)
+        c_left, c_right = self.world.phero_map.get_pheromone_concentrations(antennas, self.head_radius, self.antenna_sampling, self.sense_channel)
 
         # angle
         # maybe divide by max pheromone concentration
@@ -124,7 +131,7 @@ class Ant(WorldObject):
 
             a = 2 / ( 1 + np.exp(-4 * a))  -1
 
-            a += np.random.normal(0, self.signal_noise)
+            a += noise
 
             turn_angle = (self.max_turn_angle * a * delta)
 
@@ -133,7 +140,7 @@ class Ant(WorldObject):
             self.direction = rotate_vector(self.direction, turn_angle)
             return np.absolute(a)
         else:
-            self.direction = rotate_vector(self.direction, self.max_turn_angle * np.random.normal(0, self.signal_noise) * delta)
+            self.direction = rotate_vector(self.direction, self.max_turn_angle * noise * delta)
             return 0
 
     def circuit_world(self):
@@ -171,14 +178,18 @@ class Ant(WorldObject):
         '''
 
         #set pheromone concentration
-        self.world.phero_map.add_pheromone_concentration(self.position - (self.direction * self.length / 2), 100. * delta * self.speed)
+        tail = self.position - (self.direction * self.length / 2)
+        self.world.phero_map.add_pheromone_concentrations(tail.reshape((1, 2)), np.array([100. * delta * self.speed]), self.deposit_channel)
 
         evaded = False
         trailed = False
 
+        # drawn while evading too, like the swarm draws one value for every ant
+        noise = self.world.streams.get("noise").normal(1)[0] * self.signal_noise
+
         evaded = self.evade_objects(delta)
         if not evaded:
-            trail_change = self.trail_pheromone(delta)
+            trail_change = self.trail_pheromone(delta, noise)
 
             if trail_change >= self.phero_speed_down_treshold:
                 self.speed_down(delta)
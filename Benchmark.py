@@ -0,0 +1,123 @@
+from __future__ import division
+from Storage import *
+
+import os
+import sys
+import time
+
+
+codecs = ["none", "lzf", "lzf+shuffle", "gzip1", "gzip4", "gzip4+shuffle", "gzip9"]
+chunk_modes = ["blocks", "auto"]
+
+
+def load_frames(filename, n = None):
+    '''returns the first n frames of every group of a recording'''
+    import h5py
+    f = h5py.File(filename, "r")
+    length = f["buffer"].attrs["length"]
+    if n is not None:
+        length = min(length, n)
+
+    frames = {}
+    for name in f["buffer"].attrs["groups"]:
+        frames[name] = f["buffer"][name][:length]
+    f.close()
+
+    return frames
+
+def benchmark(frames, filename, codec, chunk_mode = "blocks", buffer_size = 100):
+    '''
+    writes frames into filename with a codec and reads them again
+
+    chunk_mode "blocks" aligns the chunks with the blocks, "auto" lets h5py choose them. Returns the
+    write and read speed in MB/s of uncompressed frames and the compression ratio.
+    '''
+    groups = sorted(frames.keys())
+    shapes = [frames[name].shape[1:] for name in groups]
+    dtypes = [frames[name].dtype for name in groups]
+    length = len(frames[groups[0]])
+    raw_mb = sum(frames[name].nbytes for name in groups) / (1024 * 1024)
+
+    chunks = [True] * len(groups) if chunk_mode == "auto" else None
+
+    if os.path.exists(filename):
+        os.remove(filename)
+
+    t = time.time()
+    s = Storage(filename, groups, shapes, dtypes, buffer_size, codec, chunks=chunks)
+    for i in range(length):
+        for name in groups:
+            s.set(name, i, frames[name][i])
+    s.store()
+    s.close()
+    write_time = time.time() - t
+
+    file_mb = os.path.getsize(filename) / (1024 * 1024)
+
+    t = time.time()
+    s = Storage(filename, buffer_size=buffer_size)
+    for i in range(length):
+        for name in groups:
+            s.get(name, i)
+    s.close()
+    read_time = time.time() - t
+
+    os.remove(filename)
+
+    return {"write": raw_mb / write_time, "read": raw_mb / read_time, "ratio": raw_mb / file_mb}
+
+def run_benchmarks(filename, codecs = codecs, chunk_modes = chunk_modes, buffer_size = 100, n = None):
+    frames = load_frames(filename, n)
+    if not frames or len(frames.values()[0]) == 0:
+        print("no frames in " + filename + ", a recording of keyframes has none")
+        return []
+
+    results = []
+    for codec in codecs:
+        for chunk_mode in chunk_modes:
+            result = benchmark(frames, filename + ".benchmark", codec, chunk_mode, buffer_size)
+            results.append((codec, chunk_mode, result))
+
+    print("")
+    print("{:<16}{:<8}{:>10}{:>10}{:>8}".format("codec", "chunks", "write", "read", "ratio"))
+    for codec, chunk_mode, result in results:
+        print("{:<16}{:<8}{:>10.1f}{:>10.1f}{:>8.2f}".format(codec, chunk_mode, result["write"], result["read"], result["ratio"]))
+    print("write and read in MB/s of uncompressed frames")
+
+    return results
+
+
+if __name__ == "__main__":
+
+    #INPUT DEFAULTS
+    buffer_size = 100
+    n = None
+    selected_codecs = []
+    selected_chunk_modes = []
+
+    if len(sys.argv) < 2:
+        print("usage: python Benchmark.py record.hdf5 [-codec codec]... [-chunks blocks|auto]... [-bs buffer size] [-n frames]")
+        sys.exit(1)
+
+    filename = sys.argv[1]
+
+    i = 2
+    while i < len(sys.argv):
+        if sys.argv[i] == "-codec":
+            selected_codecs.append(sys.argv[i+1])
+            i += 1
+        elif sys.argv[i] == "-chunks":
+            selected_chunk_modes.append(sys.argv[i+1])
+            i += 1
+        elif sys.argv[i] == "-bs":
+            buffer_size = int(sys.argv[i+1])
+            i += 1
+        elif sys.argv[i] == "-n":
+            n = int(sys.argv[i+1])
+            i += 1
+        else:
+            print("invalid parameter")
+
+        i += 1
+
+    run_benchmarks(filename, selected_codecs or codecs, selected_chunk_modes or chunk_modes, buffer_size, n)
@@ -0,0 +1,53 @@
+from __future__ import division
+import os
+
+import numpy as np
+
+
+def write_state(group, state):
+    '''writes a nested dict of arrays and numbers into a hdf5 group, dicts become subgroups'''
+    for key, value in state.items():
+        if value is None:
+            continue
+
+        if isinstance(value, dict):
+            write_state(group.create_group(key), value)
+        else:
+            value = np.asarray(value)
+            if value.ndim > 0 and value.size > 0 and value.dtype.kind != "S":
+                group.create_dataset(key, data=value, compression="lzf")
+            else:
+                group.create_dataset(key, data=value)
+
+def read_state(group):
+    import h5py
+    state = {}
+    for key, value in group.items():
+        if isinstance(value, h5py.Group):
+            state[key] = read_state(value)
+        else:
+            state[key] = value[()]
+    return state
+
+def save_checkpoint(filename, state):
+    '''
+    writes a nested dict of arrays into filename
+
+    the checkpoint is written into a temporary file which replaces filename afterwards,
+    so a crash while writing leaves the last complete checkpoint behind
+    '''
+
+    import h5py
+    temp = filename + ".tmp"
+    f = h5py.File(temp, "w")
+    write_state(f, state)
+    f.close()
+
+    os.rename(temp, filename)
+
+def load_checkpoint(filename):
+    import h5py
+    f = h5py.File(filename, "r")
+    state = read_state(f)
+    f.close()
+    return state
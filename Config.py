@@ -0,0 +1,90 @@
+from __future__ import division
+import copy
+import os
+
+import yaml
+
+
+# optional settings and their defaults, given values are converted to the type of the default
+defaults = {"spatial_index": "kdtree",
+            "neighbour_skin": 0.,
+            "diffusion_fft_steps": 4,
+            "pheromone_map": "dense",
+            "pheromone_tile_size": 50,
+            "pheromone_epsilon": 0.01,
+            "threads": 0,
+            "thread_chunk_size": 500,
+            "schedule": {}}
+
+ant_defaults = {"antenna_sampling": "nearest"}
+
+# settings of every file read so far by absolute path
+files = {}
+
+
+def get_default_path():
+    '''config.yml in the working directory, otherwise the one next to this module'''
+    if os.path.exists("config.yml"):
+        return "config.yml"
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.yml")
+
+def read_config(path = None, cached = True):
+    '''returns a copy of the settings in path, every file is only parsed once'''
+    if path is None:
+        path = get_default_path()
+    path = os.path.abspath(path)
+
+    if path not in files or not cached:
+        files[path] = yaml.load(open(path))
+
+    return copy.deepcopy(files[path])
+
+def apply_defaults(settings, defaults):
+    for key, default in defaults.items():
+        if settings.get(key) is None:
+            settings[key] = copy.deepcopy(default)
+        else:
+            settings[key] = type(default)(settings[key])
+
+
+class Config(dict):
+    '''
+    class Config holds the settings of a config file
+
+    the object config holds the settings of config.yml, it is the default config of every class
+    and function which takes one. load and set change it in place, so every module sees the new
+    settings. The settings of e.g. a sweep run or a recording go into a Config of their own,
+    which is passed to what is set up from them.
+    '''
+
+    def __init__(self, settings = None):
+        dict.__init__(self)
+        self.path = None
+
+        if settings is not None:
+            self.set(settings)
+
+    def load(self, path = None, cached = True):
+        '''reads the settings of path, None reads config.yml'''
+        if path is None:
+            path = get_default_path()
+
+        self.set(read_config(path, cached))
+        self.path = os.path.abspath(path)
+
+    def set(self, settings):
+        '''replaces all settings with a copy of settings'''
+        settings = copy.deepcopy(settings)
+
+        apply_defaults(settings, defaults)
+        apply_defaults(settings["ant"], ant_defaults)
+
+        self.clear()
+        self.update(settings)
+
+    def to_dict(self):
+        return copy.deepcopy(dict(self))
+
+
+config = Config()
+config.load()
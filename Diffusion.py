@@ -2,20 +2,40 @@ from __future__ import division
 import scipy.ndimage
 import numpy as np
 
-import yaml
-config = yaml.load(open("config.yml"))
+from Config import config
 
 class PheromoneMap():
-    def __init__(self, resolution = 1.):
+    #diffusion_matrix = np.array([[0.1,0.1,0.1],[0.1,0.2,0.1],[0.1,0.1,0.1]], dtype=np.float32)
+    diffusion_matrix = np.array([[0.0999,0.0999,0.0999],[0.0999,0.197,0.0999],[0.0999,0.0999,0.0999]], dtype=np.float32)
+
+    def __init__(self, resolution = 1., phero_map = None, phero_buffer = None, config = config):
         self.delta = 0.
 
         self.resolution = resolution
 
-        self.phero_map = np.zeros(tuple(np.array(config["world_dimension"]) * resolution), dtype=np.float32)
+        #the map and its buffer can be given, e.g. as views of shared memory
+        if phero_map is None:
+            phero_map = np.zeros(tuple(np.array(config["world_dimension"]) * resolution), dtype=np.float32)
+        self.phero_map = phero_map
+        #second map the diffusion writes into, swapped with phero_map afterwards
+        if phero_buffer is None:
+            phero_buffer = np.zeros_like(self.phero_map)
+        self.phero_buffer = phero_buffer
         self.phero_changes = []
 
-        #self.diffusion_matrix = np.array([[0.1,0.1,0.1],[0.1,0.2,0.1],[0.1,0.1,0.1]], dtype=np.float32)
-        self.diffusion_matrix = np.array([[0.0999,0.0999,0.0999],[0.0999,0.197,0.0999],[0.0999,0.0999,0.0999]], dtype=np.float32)
+        #deposits enqueued during this round as pairs of (flat map indices, amounts)
+        self.phero_deposits = []
+
+        #disk averaged copies of the map by radius, cleared whenever the map changes
+        self.disk_maps = {}
+
+        #seconds per diffusion step
+        self.diffusion_time = 0.1
+
+        #from this many steps per tick on, all steps are applied at once in the frequency domain
+        self.fft_steps = config.get("diffusion_fft_steps", 4)
+        self.fft_kernel = None
+        self.fft_kernels = {}
 
     def to_dict(self):
         d = {}
@@ -23,42 +43,409 @@ class PheromoneMap():
         d["phero_map"] = self.phero_map
         return d
 
+    def get_state(self):
+        '''returns the map, the diffusion clock and the enqueued changes, everything to continue exactly from here'''
+        state = {"phero_map": self.phero_map, "delta": self.delta}
+        state["phero_changes"] = np.array(self.phero_changes, dtype=np.float).reshape((-1, 3))
+
+        # the deposits in the order they are added up
+        state["deposit_indices"] = np.concatenate([np.empty(0, dtype=np.int)] + [i for i, a in self.phero_deposits])
+        state["deposit_amounts"] = np.concatenate([np.empty(0, dtype=np.float)] + [a for i, a in self.phero_deposits])
+        return state
+
+    def set_state(self, state):
+        self.phero_map[...] = state["phero_map"]
+        self.delta = float(state["delta"])
+        self.phero_changes = [[int(x), int(y), amount] for x, y, amount in state["phero_changes"]]
+
+        self.phero_deposits = []
+        if len(state["deposit_indices"]) > 0:
+            self.phero_deposits.append((state["deposit_indices"], state["deposit_amounts"]))
+
+        self.disk_maps = {}
+
     def tick(self, delta):
+        self.apply_changes()
+
+        # convolve to blur pheromone
+        self.diffuse(self.get_steps(delta))
+
+    def get_steps(self, delta):
+        '''advances the diffusion clock by delta and returns the number of diffusion steps which are due'''
         self.delta += delta
 
+        steps = 0
+        while self.delta > self.diffusion_time:
+            self.delta -= self.diffusion_time
+            steps += 1
+
+        return steps
+
+    def apply_changes(self):
+        self.disk_maps = {}
+
         # apply all changes enqued during last round
         for i in self.phero_changes:
             self.phero_map[i[0], i[1]] = i[2]
         self.phero_changes = []
 
-        # convolve to blur pheromone
-        while self.delta > 0.1:
-            self.delta -= 0.1
-            scipy.ndimage.filters.convolve(self.phero_map, self.diffusion_matrix, output=self.phero_map, mode="wrap")
+        # add up all deposits, several deposits into one cell accumulate
+        if self.phero_deposits:
+            indices = np.concatenate([i for i, a in self.phero_deposits])
+            amounts = np.concatenate([a for i, a in self.phero_deposits])
+            np.add.at(self.phero_map.reshape(-1), indices, amounts)
+        self.phero_deposits = []
+
+    def diffuse(self, steps):
+        '''applies the diffusion matrix steps times, a (R,H,W) map diffuses each of its R maps on its own'''
+
+        if steps >= self.fft_steps:
+            self.phero_buffer[...] = np.fft.irfft2(np.fft.rfft2(self.phero_map) * self.get_fft_kernel(steps), self.phero_map.shape[-2:])
+            self.swap_buffers()
+            return
+
+        matrix = self.diffusion_matrix.reshape((1,) * (self.phero_map.ndim - 2) + self.diffusion_matrix.shape)
+        for i in range(steps):
+            scipy.ndimage.filters.convolve(self.phero_map, matrix, output=self.phero_buffer, mode="wrap")
+            self.swap_buffers()
+
+    def convolve_rows(self, start, stop):
+        '''convolves the rows [start, stop) of the map into the buffer, reads the wrapped rows around them too'''
+        kh = self.diffusion_matrix.shape[0]
+        rows = np.arange(start - kh // 2, stop + kh // 2) % self.phero_map.shape[0]
+
+        block = scipy.ndimage.filters.convolve(self.phero_map[rows], self.diffusion_matrix, mode="wrap")
+        self.phero_buffer[start:stop] = block[kh // 2:kh // 2 + stop - start]
+
+    def swap_buffers(self):
+        self.disk_maps = {}
+        self.phero_map, self.phero_buffer = self.phero_buffer, self.phero_map
+
+    def get_fft_kernel(self, steps):
+        '''returns the spectrum of the diffusion matrix applied steps times on the wrapped map'''
+
+        if steps not in self.fft_kernels:
+            if self.fft_kernel is None:
+                # place the center of the matrix at the origin of the map
+                kernel = np.zeros(self.phero_map.shape[-2:])
+                h, w = self.diffusion_matrix.shape
+                kernel[:h, :w] = self.diffusion_matrix
+                kernel = np.roll(np.roll(kernel, -(h // 2), axis=0), -(w // 2), axis=1)
+                self.fft_kernel = np.fft.rfft2(kernel)
+
+            self.fft_kernels[steps] = self.fft_kernel ** steps
 
-        # dunno why, looks like scipy messes with the array somehow
-        self.phero_map = self.phero_map.astype(np.float32)
+        return self.fft_kernels[steps]
 
-    def convert_coordinates(self, position):
+    def get_map_coordinates(self, positions):
+        '''converts (N,2) world positions into continuous (row, col) map coordinates'''
         shift = np.array(self.phero_map.shape) / 2.
-        position = np.array((position * self.resolution) + shift, dtype=np.int)
-        for i in range(position.shape[0]):
-            if position[i] >= self.phero_map.shape[i]:
-                position[i] %= self.phero_map.shape[i]
-            elif position[i] < 0:
-                position[i] = self.phero_map.shape[i] - (-position[i] % self.phero_map.shape[i])
-        return position
+        # rows follow the second, cols the first world coordinate
+        return (positions[:, ::-1] * self.resolution) + shift
+
+    def get_indices(self, positions):
+        '''converts (N,2) world positions into (rows, cols) of the map, wrapped around the borders'''
+        cells = np.floor(self.get_map_coordinates(positions)).astype(np.int)
+        cells = np.mod(cells, self.phero_map.shape)
+        return cells[:, 0], cells[:, 1]
+
+    def get_channel(self, channel = None):
+        '''returns the map of a pheromone channel, a single map has no channels besides itself'''
+        return self.phero_map
+
+    def get_disk_map(self, radius, channel = None):
+        '''returns the map averaged over a disk of radius around every cell'''
+        if (channel, radius) not in self.disk_maps:
+            r = max(0, int(radius * self.resolution))
+            y, x = np.mgrid[-r:r + 1, -r:r + 1]
+            disk = (x * x + y * y <= r * r).astype(np.float32)
+            disk /= disk.sum()
+
+            self.disk_maps[(channel, radius)] = scipy.ndimage.filters.convolve(self.get_channel(channel), disk, mode="wrap")
+
+        return self.disk_maps[(channel, radius)]
 
     def get_pheromone_concentration(self, position, radius):
-        y,x = self.convert_coordinates(position)
-        return self.phero_map[x,y]
+        return self.get_pheromone_concentrations(np.array(position, dtype=np.float).reshape((1, 2)), radius)[0]
+
+    def get_pheromone_concentrations(self, positions, radius, mode = "nearest", channel = None):
+        '''returns the concentrations at a (N,2) array of positions
+
+        mode = "nearest" reads the cell of every position, "bilinear" interpolates between the four
+        closest cell centers and "disk" reads the average over a disk of radius around the cell
+        '''
+
+        phero_map = self.get_channel(channel)
+
+        if mode == "bilinear":
+            coordinates = self.get_map_coordinates(positions) - 0.5
+            low = np.floor(coordinates)
+            t = coordinates - low
+
+            r0, c0 = np.mod(low.astype(np.int), phero_map.shape).T
+            r1 = (r0 + 1) % phero_map.shape[0]
+            c1 = (c0 + 1) % phero_map.shape[1]
+
+            top = phero_map[r0, c0] * (1 - t[:, 1]) + phero_map[r0, c1] * t[:, 1]
+            bottom = phero_map[r1, c0] * (1 - t[:, 1]) + phero_map[r1, c1] * t[:, 1]
+            return top * (1 - t[:, 0]) + bottom * t[:, 0]
+
+        rows, cols = self.get_indices(positions)
+
+        if mode == "disk":
+            return self.get_disk_map(radius, channel)[rows, cols]
+
+        return phero_map[rows, cols]
 
     def set_pheromone_concentration(self, position, amount):
-        y,x = self.convert_coordinates(position)
+        rows, cols = self.get_indices(np.array(position, dtype=np.float).reshape((1, 2)))
         # enque for application after round
-        self.phero_changes.append([x, y, amount])
+        self.phero_changes.append([int(rows[0]), int(cols[0]), amount])
 
     def add_pheromone_concentration(self, position, amount):
-        y,x = self.convert_coordinates(position)
+        self.add_pheromone_concentrations(np.array(position, dtype=np.float).reshape((1, 2)), np.array([amount], dtype=np.float))
+
+    def add_pheromone_concentrations(self, positions, amounts, channel = None):
+        '''adds amounts[i] at positions[i] for a (N,2) array of positions'''
+        rows, cols = self.get_indices(positions)
         # enque for application after round
-        self.phero_changes.append([x, y, self.phero_map[x,y] + amount])
+        self.phero_deposits.append((np.ravel_multi_index((rows, cols), self.phero_map.shape), amounts))
+
+
+class TiledPheromoneMap(PheromoneMap):
+    '''
+    class TiledPheromoneMap splits the map into tiles and only diffuses the tiles which hold pheromone
+
+    a tile is active while one of its cells exceeds epsilon, inactive tiles are all zero.
+    Every diffusion step convolves the active tiles and their neighbours, which receive the spread
+    over the one cell halo. The map itself stays a dense array, so reading it works as before.
+    '''
+
+    def __init__(self, resolution = 1., tile_size = 50, epsilon = 0.01, config = config):
+        PheromoneMap.__init__(self, resolution, config=config)
+        self.epsilon = epsilon
+
+        # tiles evenly divide the map
+        self.tile_shape = np.array([get_tile_size(n, tile_size) for n in self.phero_map.shape])
+        self.tile_count = np.array(self.phero_map.shape) // self.tile_shape
+        self.active = np.zeros(self.tile_count, dtype=bool)
+
+    def apply_changes(self):
+        # activate the tiles which get pheromone
+        cells = [np.array([[i[0], i[1]] for i in self.phero_changes], dtype=np.int).reshape((-1, 2))]
+        for indices, amounts in self.phero_deposits:
+            cells.append(np.array(np.unravel_index(indices, self.phero_map.shape)).T)
+        tiles = np.concatenate(cells) // self.tile_shape
+        self.active[tiles[:, 0], tiles[:, 1]] = True
+
+        PheromoneMap.apply_changes(self)
+
+    def get_state(self):
+        state = PheromoneMap.get_state(self)
+        state["active"] = self.active
+        return state
+
+    def set_state(self, state):
+        PheromoneMap.set_state(self, state)
+        self.active[...] = state["active"]
+
+    def diffuse(self, steps):
+        for i in range(steps):
+            self.diffuse_tiles()
+
+    def get_tiles(self):
+        '''returns the map as (tile rows, tile height, tile cols, tile width) view'''
+        th, tw = self.tile_shape
+        ny, nx = self.tile_count
+        return self.phero_map.reshape((ny, th, nx, tw))
+
+    def diffuse_tiles(self):
+        # active tiles and their neighbours, wrapped around the borders
+        near = np.zeros_like(self.active)
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                near |= np.roll(np.roll(self.active, dy, axis=0), dx, axis=1)
+        ty, tx = np.nonzero(near)
+
+        if len(ty) == 0:
+            return
+
+        th, tw = self.tile_shape
+        kh, kw = self.diffusion_matrix.shape
+
+        # gather every tile with its halo
+        rows = (ty[:, np.newaxis] * th - kh // 2 + np.arange(th + kh - 1)) % self.phero_map.shape[0]
+        cols = (tx[:, np.newaxis] * tw - kw // 2 + np.arange(tw + kw - 1)) % self.phero_map.shape[1]
+        windows = self.phero_map[rows[:, :, np.newaxis], cols[:, np.newaxis, :]]
+
+        # convolve all tiles at once
+        kernel = self.diffusion_matrix[::-1, ::-1]
+        tiles = np.zeros((len(ty), th, tw), dtype=np.float32)
+        for i in range(kh):
+            for j in range(kw):
+                tiles += kernel[i, j] * windows[:, i:i + th, j:j + tw]
+
+        # drop tiles which decayed
+        alive = tiles.reshape((len(ty), -1)).max(axis=1) >= self.epsilon
+        tiles[~alive] = 0.
+
+        self.get_tiles()[ty, :, tx, :] = tiles
+        self.active[ty, tx] = alive
+        self.disk_maps = {}
+
+
+class PheromoneStack(PheromoneMap):
+    '''
+    class PheromoneStack holds several named pheromone channels in one (C,H,W) array
+
+    every channel has its own diffusion matrix (None for the default one) and decay factor per
+    diffusion step, all channels are diffused at once. phero_map is the first channel, so code reading a single map keeps working.
+    '''
+
+    def __init__(self, channels, kernels, decays, resolution = 1., config = config):
+        PheromoneMap.__init__(self, resolution, config=config)
+
+        self.channels = list(channels)
+        shape = (len(self.channels),) + self.phero_map.shape
+        self.stack = np.zeros(shape, dtype=np.float32)
+        self.stack_buffer = np.zeros(shape, dtype=np.float32)
+        self.phero_map = self.stack[0]
+        self.phero_buffer = None
+
+        # channels without their own matrix use the default one
+        kernels = [self.diffusion_matrix if k is None else k for k in kernels]
+
+        # center all matrices in kernels of the same size
+        kh = max(np.shape(k)[0] for k in kernels)
+        kw = max(np.shape(k)[1] for k in kernels)
+        self.kernels = np.zeros((len(self.channels), kh, kw), dtype=np.float32)
+        for c, kernel in enumerate(kernels):
+            kernel = np.array(kernel, dtype=np.float32)
+            top = (kh - kernel.shape[0]) // 2
+            left = (kw - kernel.shape[1]) // 2
+            self.kernels[c, top:top + kernel.shape[0], left:left + kernel.shape[1]] = kernel
+
+        self.decays = np.array(decays, dtype=np.float32)
+
+        # the stack with a wrapped border for the direct convolution
+        self.padded = np.zeros((len(self.channels), shape[1] + kh - 1, shape[2] + kw - 1), dtype=np.float32)
+
+    def to_dict(self):
+        d = PheromoneMap.to_dict(self)
+        d["channels"] = self.channels
+        d["stack"] = self.stack
+        return d
+
+    def get_channel(self, channel = None):
+        if channel is None:
+            return self.phero_map
+        return self.stack[self.channels.index(channel)]
+
+    def get_state(self):
+        state = PheromoneMap.get_state(self)
+        # phero_map is the first channel of the stack
+        del state["phero_map"]
+        state["stack"] = self.stack
+        return state
+
+    def set_state(self, state):
+        state = dict(state)
+        state["phero_map"] = state["stack"][0]
+        PheromoneMap.set_state(self, state)
+        self.stack[...] = state["stack"]
+
+    def apply_changes(self):
+        self.disk_maps = {}
+
+        # apply all changes enqued during last round
+        for i in self.phero_changes:
+            self.phero_map[i[0], i[1]] = i[2]
+        self.phero_changes = []
+
+        # add up all deposits, several deposits into one cell accumulate
+        if self.phero_deposits:
+            indices = np.concatenate([i for i, a in self.phero_deposits])
+            amounts = np.concatenate([a for i, a in self.phero_deposits])
+            np.add.at(self.stack.reshape(-1), indices, amounts)
+        self.phero_deposits = []
+
+    def add_pheromone_concentrations(self, positions, amounts, channel = None):
+        rows, cols = self.get_indices(positions)
+        c = np.full(len(rows), 0 if channel is None else self.channels.index(channel), dtype=np.int)
+        # enque for application after round
+        self.phero_deposits.append((np.ravel_multi_index((c, rows, cols), self.stack.shape), amounts))
+
+    def diffuse(self, steps):
+        if steps == 0:
+            return
+
+        if steps >= self.fft_steps:
+            spectrum = np.fft.rfft2(self.stack, axes=(1, 2)) * self.get_fft_kernel(steps)
+            self.stack_buffer[...] = np.fft.irfft2(spectrum, self.stack.shape[1:], axes=(1, 2))
+            self.swap_buffers()
+            return
+
+        for i in range(steps):
+            self.convolve()
+            self.swap_buffers()
+
+    def convolve(self):
+        '''convolves every channel with its kernel into stack_buffer'''
+
+        c, h, w = self.stack.shape
+        kh, kw = self.kernels.shape[1:]
+        top, left = kh // 2, kw // 2
+
+        # wrap the borders around
+        padded = self.padded
+        padded[:, top:top + h, left:left + w] = self.stack
+        padded[:, :top, left:left + w] = self.stack[:, h - top:]
+        padded[:, top + h:, left:left + w] = self.stack[:, :kh - 1 - top]
+        padded[:, :, :left] = padded[:, :, w:w + left]
+        padded[:, :, left + w:] = padded[:, :, left:kw - 1]
+
+        kernels = (self.kernels * self.decays[:, np.newaxis, np.newaxis])[:, ::-1, ::-1]
+        self.stack_buffer.fill(0.)
+        for i in range(kh):
+            for j in range(kw):
+                self.stack_buffer += kernels[:, i, j, np.newaxis, np.newaxis] * padded[:, i:i + h, j:j + w]
+
+    def swap_buffers(self):
+        self.disk_maps = {}
+        self.stack, self.stack_buffer = self.stack_buffer, self.stack
+        self.phero_map = self.stack[0]
+
+    def get_fft_kernel(self, steps):
+        if steps not in self.fft_kernels:
+            if self.fft_kernel is None:
+                # place the center of every kernel at the origin of the map
+                c, kh, kw = self.kernels.shape
+                kernel = np.zeros(self.stack.shape)
+                kernel[:, :kh, :kw] = self.kernels * self.decays[:, np.newaxis, np.newaxis]
+                kernel = np.roll(np.roll(kernel, -(kh // 2), axis=1), -(kw // 2), axis=2)
+                self.fft_kernel = np.fft.rfft2(kernel, axes=(1, 2))
+
+            self.fft_kernels[steps] = self.fft_kernel ** steps
+
+        return self.fft_kernels[steps]
+
+
+def get_tile_size(n, tile_size):
+    '''returns the largest divisor of n which is not larger than tile_size'''
+    for size in range(min(n, tile_size), 0, -1):
+        if n % size == 0:
+            return size
+    return 1
+
+def create_pheromone_map(resolution = 1., config = config):
+    '''returns the pheromone map chosen in the config'''
+    channels = config.get("pheromones")
+    if channels:
+        return PheromoneStack([c["name"] for c in channels],
+                              [c.get("diffusion_matrix") for c in channels],
+                              [c.get("decay", 1.) for c in channels],
+                              resolution, config)
+
+    if config.get("pheromone_map", "dense") == "tiled":
+        return TiledPheromoneMap(resolution, config.get("pheromone_tile_size", 50), config.get("pheromone_epsilon", 0.01), config)
+    return PheromoneMap(resolution, config=config)
@@ -0,0 +1,204 @@
+from __future__ import division
+from World import *
+from Swarm import *
+
+import multiprocessing
+import numpy as np
+
+from Config import config
+
+
+class Barrier():
+    '''
+    class Barrier blocks until all parties called wait, it can be used again afterwards
+    '''
+
+    def __init__(self, parties):
+        self.parties = parties
+        self.count = multiprocessing.Value("i", 0, lock=False)
+        self.generation = multiprocessing.Value("i", 0, lock=False)
+        self.condition = multiprocessing.Condition()
+
+    def wait(self):
+        with self.condition:
+            generation = self.generation.value
+            self.count.value += 1
+
+            if self.count.value == self.parties:
+                self.count.value = 0
+                self.generation.value += 1
+                self.condition.notify_all()
+            else:
+                while generation == self.generation.value:
+                    self.condition.wait()
+
+
+def shared_array(typecode, shape):
+    '''returns a numpy view and the RawArray in shared memory behind it'''
+    raw = multiprocessing.RawArray(typecode, int(np.prod(shape)))
+    dtype = np.float32 if typecode == "f" else np.float64
+    return np.frombuffer(raw, dtype=dtype).reshape(shape), raw
+
+def shared_view(raw, typecode, shape):
+    dtype = np.float32 if typecode == "f" else np.float64
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+class DomainWorld():
+    '''
+    class DomainWorld splits the world into strips of pheromone map rows, each simulated by a worker process
+
+    the ant arrays and both pheromone maps live in shared memory. A worker ticks the ants inside
+    its strip together with the ants in a halo around it, so collisions and deposits across the
+    strip border are seen, and writes back only its own ants and rows. Ants which cross a border
+    belong to the next strip from the following tick on.
+    '''
+
+    def __init__(self, swarm, workers = 2, seed = None, config = config):
+        self.config = config
+
+        self.dimensions = np.array(config["world_dimension"])
+        self.delta_time = config["delta"]
+
+        # the ants live in the workers, live config changes don't reach them
+        self.swarm = None
+        self.world_objects = []
+
+        count = swarm.get_count()
+        self.positions, positions = shared_array("d", (count, 2))
+        self.directions, directions = shared_array("d", (count, 2))
+        self.speeds, speeds = shared_array("d", (count,))
+
+        shift = self.dimensions / 2
+        self.positions[...] = np.mod(swarm.positions + shift, self.dimensions) - shift
+        self.directions[...] = swarm.directions
+        self.speeds[...] = swarm.speeds
+
+        shape = tuple(int(d) for d in self.dimensions)
+        phero_map, maps = shared_array("f", shape)
+        phero_buffer, buffers = shared_array("f", shape)
+        self.phero_map = PheromoneMap(1., phero_map, phero_buffer, config)
+
+        # strips of map rows and the halo of rows around them, which holds the ants
+        # which can collide with or lay pheromone into the strip
+        ant = config["ant"]
+        halo = max(max(ant["center_radius"], ant["head_radius"]) * 2, ant["length"] / 2)
+        halo_rows = int(np.ceil(halo * self.phero_map.resolution)) + 1
+        bounds = np.linspace(0, shape[0], workers + 1).astype(np.int)
+
+        # every worker draws from its own streams of the seed
+        self.streams = RandomStreams(seed)
+
+        self.barrier = Barrier(workers)
+        self.commands = [multiprocessing.Queue() for i in range(workers)]
+        self.done = multiprocessing.Queue()
+        self.workers = []
+
+        for i in range(workers):
+            args = (bounds[i], bounds[i + 1], halo_rows, self.streams.seed, i, count, shape,
+                    positions, directions, speeds, maps, buffers,
+                    self.barrier, self.commands[i], self.done, config)
+            p = multiprocessing.Process(target=run_worker, args=args)
+            p.daemon = True
+            p.start()
+            self.workers.append(p)
+
+    def world_objects_to_numpy(self, type=None):
+        arr = np.zeros((3, self.get_ant_count(), 2), dtype=np.float32)
+        arr[0] = self.positions
+        arr[1] = self.directions
+        arr[2] = self.speeds[:, np.newaxis]
+        return arr
+
+    def get_ant_count(self):
+        return self.positions.shape[0]
+
+    def simulate(self, n):
+        '''lets the workers simulate n ticks'''
+        for c in self.commands:
+            c.put(n)
+        for c in self.commands:
+            self.done.get()
+
+        # follow the buffer swaps of the workers
+        for i in range(n):
+            for s in range(self.phero_map.get_steps(self.delta_time)):
+                self.phero_map.swap_buffers()
+
+    def tick(self):
+        self.simulate(1)
+
+    def close(self):
+        for c in self.commands:
+            c.put(None)
+        for p in self.workers:
+            p.join()
+
+
+def run_worker(start, stop, halo_rows, seed, index, count, shape, positions, directions, speeds, maps, buffers, barrier, commands, done, config):
+    '''simulates the strip of map rows [start, stop) until it gets None as command'''
+
+    positions = shared_view(positions, "d", (count, 2))
+    directions = shared_view(directions, "d", (count, 2))
+    speeds = shared_view(speeds, "d", (count,))
+    phero_map = PheromoneMap(1., shared_view(maps, "f", shape), shared_view(buffers, "f", shape), config)
+
+    world = World(phero_map, RandomStreams(seed, index + 1), config)
+    # the ants of a strip change every tick, so cached neighbour pairs can't be used
+    if isinstance(world.neighbour_index, VerletList):
+        world.neighbour_index = world.neighbour_index.index
+
+    swarm = Swarm(np.empty((0, 2)), np.empty((0, 2)), config=config)
+    world.set_swarm(swarm)
+
+    while True:
+        n = commands.get()
+        if n is None:
+            return
+
+        for i in range(n):
+            # ants in the strip and in the halo around it
+            rows = phero_map.get_indices(positions)[0]
+            owned = (rows >= start) & (rows < stop)
+            near = ((start - rows) % shape[0] <= halo_rows) | ((rows - stop + 1) % shape[0] <= halo_rows)
+            local = np.flatnonzero(owned | near)
+            owned = owned[local]
+
+            swarm.positions = positions[local]
+            swarm.directions = directions[local]
+            swarm.speeds = speeds[local]
+
+            world.update_neighbour_index()
+            swarm.tick(world.delta_time)
+
+            # everybody read the old state
+            barrier.wait()
+
+            positions[local[owned]] = swarm.positions[owned]
+            directions[local[owned]] = swarm.directions[owned]
+            speeds[local[owned]] = swarm.speeds[owned]
+
+            apply_deposits(phero_map, start, stop)
+
+            # everybody wrote the new state
+            barrier.wait()
+
+            for s in range(phero_map.get_steps(world.delta_time)):
+                phero_map.convolve_rows(start, stop)
+                barrier.wait()
+                phero_map.swap_buffers()
+
+        done.put(start)
+
+def apply_deposits(phero_map, start, stop):
+    '''adds the enqueued deposits which fall into the rows [start, stop)'''
+
+    if phero_map.phero_deposits:
+        indices = np.concatenate([i for i, a in phero_map.phero_deposits])
+        amounts = np.concatenate([a for i, a in phero_map.phero_deposits])
+
+        rows = indices // phero_map.phero_map.shape[1]
+        inside = (rows >= start) & (rows < stop)
+        phero_map.phero_deposits = [(indices[inside], amounts[inside])]
+
+    phero_map.apply_changes()
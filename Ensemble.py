@@ -0,0 +1,157 @@
+from __future__ import division
+import Simulator as simulator
+import Global as g
+from Config import Config, read_config
+
+import copy
+import itertools
+import multiprocessing
+import os
+import sys
+
+import yaml
+
+
+def load_sweep(filename):
+    '''
+    loads a sweep specification, e.g.
+
+    config: config.yml        # base config of every run
+    output: sweep             # directory of the run files
+    seed: 1                   # run i is seeded with seed + i
+    replicas: 10              # runs per parameter combination
+    seconds: 60
+    record_step: 10
+    ant_count: 100
+    parameters:               # every combination of these values is simulated
+      ant.max_turn_angle: [40, 60]
+      ant.angle_noise_error: [0.1, 0.25]
+    '''
+
+    sweep = {"config": "config.yml", "output": "sweep", "seed": 0, "replicas": 1,
+             "seconds": 5., "record_step": 10, "ant_count": 20, "buffer_size": 100,
+             "engine": "swarm", "parameters": {}}
+    sweep.update(yaml.load(open(filename)))
+    return sweep
+
+def set_parameter(config, key, value):
+    '''sets a dotted key like ant.max_speed in a nested config'''
+    keys = key.split(".")
+    for k in keys[:-1]:
+        config = config[k]
+    config[keys[-1]] = value
+
+def create_runs(sweep):
+    '''returns one job per replica of every parameter combination'''
+
+    base_config = read_config(sweep["config"])
+    keys = sorted(sweep["parameters"].keys())
+
+    runs = []
+    for values in itertools.product(*[sweep["parameters"][k] for k in keys]):
+        for replica in range(sweep["replicas"]):
+            index = len(runs)
+
+            config = copy.deepcopy(base_config)
+            for key, value in zip(keys, values):
+                set_parameter(config, key, value)
+
+            runs.append({"index": index,
+                         "seed": sweep["seed"] + index,
+                         "replica": replica,
+                         "parameters": dict(zip(keys, values)),
+                         "config": config,
+                         "filename": os.path.join(sweep["output"], "run_" + str(index).zfill(5) + ".hdf5"),
+                         "seconds": sweep["seconds"],
+                         "record_step": sweep["record_step"],
+                         "ant_count": sweep["ant_count"],
+                         "buffer_size": sweep["buffer_size"],
+                         "engine": sweep["engine"]})
+
+    return runs
+
+def is_complete(filename):
+    '''a run is complete once it is marked so, which happens after recording'''
+    if not os.path.exists(filename):
+        return False
+
+    import h5py
+    try:
+        f = h5py.File(filename, "r")
+        complete = "keyval" in f and "complete" in f["keyval"].attrs
+        f.close()
+        return complete
+    except IOError:
+        return False
+
+def run(job):
+    '''simulates and records one run, returns its index'''
+
+    # an interrupted run starts over
+    if os.path.exists(job["filename"]):
+        os.remove(job["filename"])
+
+    s = simulator.setup(job["ant_count"], job["engine"], seed = job["seed"], config = Config(job["config"]))
+    s.record(job["filename"], job["seconds"], job["record_step"], job["buffer_size"], verbose=False)
+
+    sto = g.storage
+    sto.keyval_set("replica", job["replica"])
+    for key, value in job["parameters"].items():
+        sto.keyval_set("parameter:" + key, value)
+    sto.keyval_set("complete", True)
+
+    g.storage = None
+    sto.close()
+
+    return job["index"]
+
+def run_sweep(sweep, processes = None):
+    '''runs all jobs of the sweep which are not complete yet over a process pool'''
+
+    runs = create_runs(sweep)
+
+    if not os.path.exists(sweep["output"]):
+        os.makedirs(sweep["output"])
+
+    # which run has which parameters and seed
+    manifest = [{"index": r["index"], "seed": r["seed"], "replica": r["replica"],
+                 "parameters": r["parameters"], "filename": r["filename"]} for r in runs]
+    yaml.dump(manifest, open(os.path.join(sweep["output"], "runs.yml"), "w"))
+
+    todo = [r for r in runs if not is_complete(r["filename"])]
+    print("#" + str(len(runs) - len(todo)) + " of " + str(len(runs)) + " runs already complete")
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for i, index in enumerate(pool.imap_unordered(run, todo)):
+            print("#run " + str(index) + " done (" + str(i + 1) + "/" + str(len(todo)) + ")")
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+if __name__ == "__main__":
+
+    #INPUT DEFAULTS
+    processes = None
+
+    if len(sys.argv) < 2:
+        print("usage: python Ensemble.py sweep.yml [-p processes]")
+        sys.exit(1)
+
+    filename = sys.argv[1]
+
+    i = 2
+    while i < len(sys.argv):
+        if sys.argv[i] == "-p":
+            processes = int(sys.argv[i+1])
+            i += 1
+        else:
+            print("invalid parameter")
+
+        i += 1
+
+    run_sweep(load_sweep(filename), processes)
@@ -0,0 +1,107 @@
+from __future__ import division
+from Storage import *
+from Checkpoint import *
+from Config import Config
+
+import collections
+
+import yaml
+
+
+def open_recording(file_name, buffer_size = 100, cache_size = 100, prefetch_depth = 1, cache_mb = 256):
+    '''opens a recording, a recording of keyframes as LazyStorage'''
+    import h5py
+    f = h5py.File(file_name, "r")
+    lazy = "keyframes" in f
+    f.close()
+
+    if lazy:
+        return LazyStorage(file_name, cache_size)
+    return Storage(file_name, buffer_size=buffer_size, prefetch_depth=prefetch_depth, cache_mb=cache_mb)
+
+
+class LazyStorage():
+    '''
+    class LazyStorage reads a recording of keyframes (see Simulator.record) like a Storage
+
+    a frame which is not cached is simulated again, starting at the closest keyframe before it or
+    at the last simulated frame if that is closer. Every simulated frame is kept in a LRU cache of
+    cache_size frames. It relies on the simulation being deterministic for a seed and config.
+    '''
+
+    def __init__(self, file_name, cache_size = 100):
+        import h5py
+        self.file = h5py.File(file_name, "a")
+
+        self.length = self.keyval_get("frame_count")
+        self.record_step = self.keyval_get("record_step")
+        self.keyframes = sorted(int(name) for name in self.file["keyframes"])
+
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+
+        # the simulator regenerating the frames and the frame it is at
+        self.simulator = None
+        self.frame = None
+
+    def __del__(self):
+        self.file.close()
+
+    def keyval_set(self, key, val):
+        self.file["keyval"].attrs[key] = val
+
+    def keyval_get(self, key):
+        return self.file["keyval"].attrs[key]
+
+    def get(self, group, index):
+        if index < 0 or index >= self.length:
+            return None
+
+        if index in self.cache:
+            # most recently used frames are at the end
+            frame = self.cache.pop(index)
+            self.cache[index] = frame
+        else:
+            frame = self.regenerate(index)
+
+        return frame.get(group)
+
+    def regenerate(self, index):
+        keyframe = max(k for k in self.keyframes if k <= index)
+
+        if self.simulator is None or self.frame > index or self.frame < keyframe:
+            self.load_keyframe(keyframe)
+
+        while self.frame < index:
+            self.simulator.run(self.record_step, report_interval = None)
+            self.frame += 1
+            self.add_frame()
+
+        return self.cache[index]
+
+    def load_keyframe(self, keyframe):
+        if self.simulator is None:
+            # the simulator module imports this one
+            import Simulator as simulator
+
+            recording_config = Config(yaml.load(str(self.keyval_get("config"))))
+            self.simulator = simulator.setup(self.keyval_get("ant_count"), str(self.keyval_get("engine")), config = recording_config)
+
+        self.simulator.set_state(read_state(self.file["keyframes"][str(keyframe)]))
+        self.frame = keyframe
+        self.add_frame()
+
+    def add_frame(self):
+        world = self.simulator.world
+
+        frame = {"ant": world.world_objects_to_numpy(), "phero": world.phero_map.phero_map.copy()}
+        if hasattr(world.phero_map, "stack"):
+            frame["phero_stack"] = world.phero_map.stack.copy()
+
+        self.cache.pop(self.frame, None)
+        self.cache[self.frame] = frame
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def store(self):
+        return
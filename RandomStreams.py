@@ -0,0 +1,99 @@
+from __future__ import division
+import os
+import zlib
+
+import numpy as np
+
+
+def create_seed():
+    '''returns a fresh seed from the operating system'''
+    return int(np.frombuffer(os.urandom(4), dtype=np.uint32)[0] >> 1)
+
+def get_generator_state(generator):
+    name, keys, pos, has_gauss, cached_gaussian = generator.get_state()
+    return {"keys": keys, "pos": pos, "has_gauss": has_gauss, "cached_gaussian": cached_gaussian}
+
+def set_generator_state(generator, state):
+    generator.set_state(("MT19937", state["keys"], int(state["pos"]), int(state["has_gauss"]), float(state["cached_gaussian"])))
+
+
+class RandomStream():
+    '''
+    class RandomStream is a seeded generator which draws its normal noise in blocks
+
+    the noise only depends on how many values were taken before, not on how they were taken
+    '''
+
+    def __init__(self, seed, block_size = 4096):
+        self.generator = np.random.RandomState(seed)
+        self.block_size = block_size
+
+        self.block = np.empty(0, dtype=np.float)
+        self.index = 0
+
+    def normal(self, n):
+        '''returns the next n standard normal values'''
+        if self.index + n > len(self.block):
+            rest = self.block[self.index:]
+            fresh = self.generator.standard_normal(max(self.block_size, n - len(rest)))
+            self.block = np.concatenate((rest, fresh))
+            self.index = 0
+
+        values = self.block[self.index:self.index + n]
+        self.index += n
+        return values
+
+    def uniform(self, low, high, size):
+        return self.generator.uniform(low, high, size)
+
+    def get_state(self):
+        state = get_generator_state(self.generator)
+        state["block"] = self.block[self.index:]
+        return state
+
+    def set_state(self, state):
+        set_generator_state(self.generator, state)
+        self.block = np.array(state["block"], dtype=np.float)
+        self.index = 0
+
+
+class RandomStreams():
+    '''
+    class RandomStreams hands out independent random streams derived from one seed
+
+    a stream is named, e.g. "setup" for the initial ants and "noise" for the antenna noise, and the
+    index tells apart the streams of e.g. several workers. The same seed, name and index always give
+    the same stream, no matter in which order or in which process it is created.
+    '''
+
+    def __init__(self, seed = None, index = 0, block_size = 4096):
+        if seed is None:
+            seed = create_seed()
+        self.seed = int(seed)
+        self.index = int(index)
+        self.block_size = block_size
+
+        self.streams = {}
+
+    def get(self, name, index = 0):
+        key = name + "_" + str(index)
+        if key not in self.streams:
+            # crc32 is the same in every process, unlike hash
+            seed = [self.seed, zlib.crc32(name.encode("utf-8")) & 0xffffffff, self.index, int(index)]
+            self.streams[key] = RandomStream(seed, self.block_size)
+        return self.streams[key]
+
+    def get_state(self):
+        state = {"seed": self.seed, "index": self.index, "streams": {}}
+        for key, stream in self.streams.items():
+            state["streams"][key] = stream.get_state()
+        return state
+
+    def set_state(self, state):
+        self.seed = int(state["seed"])
+        self.index = int(state["index"])
+
+        self.streams = {}
+        for key, stream_state in state["streams"].items():
+            name, index = key.rsplit("_", 1)
+            self.get(name, int(index)).set_state(stream_state)
@@ -0,0 +1,153 @@
+from __future__ import division
+from Swarm import *
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from Config import config
+
+
+class ReplicaSwarm():
+    '''
+    class ReplicaSwarm simulates many independent small worlds at once
+
+    positions and directions are (R,N,2) arrays, speeds is a (R,N) array and every replica has its
+    own pheromone map in the (R,H,W) array of phero_map, which diffuses them all at once. Every ant parameter of config.yml can
+    differ between the replicas, it is stored as (R,1) array, e.g.
+
+        replicas = ReplicaSwarm(1000, 20, {"max_turn_angle": np.linspace(20, 80, 1000)}, (100, 100))
+        replicas.simulate(200)
+    '''
+
+    parameter_names = ["max_speed", "min_speed", "max_turn_angle", "acceleration",
+                       "length", "center_radius", "head_radius", "head_angle",
+                       "angle_noise_error", "phero_speed_down_treshold"]
+
+    def __init__(self, replicas, count, parameters = {}, dimensions = None, seed = None, config = config):
+        if dimensions is None:
+            dimensions = config["world_dimension"]
+        self.dimensions = np.array(dimensions, dtype=np.float)
+        self.delta_time = config["delta"]
+
+        # ant parameters, given per replica or the same for all
+        for name in ReplicaSwarm.parameter_names:
+            value = np.array(parameters.get(name, config["ant"][name]), dtype=np.float)
+            setattr(self, name, value.reshape((-1, 1)) * np.ones((replicas, 1)))
+
+        self.streams = RandomStreams(seed)
+        setup = self.streams.get("setup")
+        self.positions = setup.uniform(-0.5, 0.5, (replicas, count, 2)) * self.dimensions
+        self.directions = norm_vectors(setup.uniform(-1, 1, (replicas, count, 2)))
+        self.speeds = np.ones((replicas, count)) * self.min_speed
+
+        shape = (replicas,) + tuple(int(d) for d in self.dimensions)
+        self.phero_map = PheromoneMap(1., np.zeros(shape, dtype=np.float32), np.zeros(shape, dtype=np.float32), config)
+
+        # wraps positions and differences around the borders, all replicas have the same dimensions
+        self.index = NeighbourIndex(self.dimensions)
+
+    def get_replica_count(self):
+        return self.positions.shape[0]
+
+    def get_count(self):
+        return self.positions.shape[1]
+
+    def to_numpy(self, replica):
+        '''returns the ants of a replica like World.world_objects_to_numpy'''
+        arr = np.zeros((3, self.get_count(), 2), dtype=np.float32)
+        arr[0] = self.positions[replica]
+        arr[1] = self.directions[replica]
+        arr[2] = self.speeds[replica, :, np.newaxis]
+        return arr
+
+    def get_indices(self, positions):
+        '''converts (R,N,2) world positions into flat indices of the maps of phero_map, wrapped around the borders'''
+        replicas, height, width = self.phero_map.phero_map.shape
+        cells = np.floor(positions[..., ::-1] + np.array([height, width]) / 2.).astype(np.int)
+        rows = np.mod(cells[..., 0], height)
+        cols = np.mod(cells[..., 1], width)
+        return ((np.arange(replicas)[:, np.newaxis] * height + rows) * width + cols).ravel()
+
+    def get_concentrations(self, positions):
+        return self.phero_map.phero_map.reshape(-1)[self.get_indices(positions)].reshape(positions.shape[:2])
+
+    def get_collision_vectors(self):
+        '''returns the weighted collision vector of every ant and a mask of the ants which have to evade'''
+
+        replicas, count = self.speeds.shape
+        radius = max(self.center_radius.max(), self.head_radius.max()) * 2
+
+        # one periodic kd tree for all replicas, they lie further than radius apart on the third axis
+        spacing = radius + 1.
+        points = np.empty((replicas * count, 3))
+        points[:, :2] = self.index.wrap(self.positions.reshape((-1, 2)))
+        points[:, 2] = np.repeat(np.arange(replicas) * spacing, count)
+        tree = cKDTree(points, 50, boxsize=np.append(self.dimensions, replicas * spacing))
+
+        pairs = tree.query_pairs(radius, output_type="ndarray")
+        rows = np.concatenate((pairs[:, 0], pairs[:, 1]))
+        cols = np.concatenate((pairs[:, 1], pairs[:, 0]))
+
+        positions = self.positions.reshape((-1, 2))
+        diff = self.index.get_difference(positions[rows], positions[cols])
+        others = np.any(diff != 0, axis=1)
+        rows, diff = rows[others], diff[others]
+
+        # parameters of the replica of every pair
+        replica = rows // count
+        collision_vectors, colliding = get_weighted_collision_vectors(rows, diff, self.directions.reshape((-1, 2))[rows], replicas * count,
+                                                                      self.center_radius[replica, 0], self.head_radius[replica, 0], self.head_angle[replica, 0])
+
+        return collision_vectors.reshape(self.positions.shape), colliding.reshape(self.speeds.shape)
+
+    def trail_pheromone(self, delta):
+        '''returns the directions turned to the side with higher pheromone concentration and the absolute turn signal'''
+
+        heads = self.positions + self.directions * (self.length / 2)[..., np.newaxis]
+        antenna = self.directions * self.head_radius[..., np.newaxis]
+        c_left = self.get_concentrations(heads + rotate_vectors(antenna, self.head_angle / 2))
+        c_right = self.get_concentrations(heads + rotate_vectors(antenna, 360 - self.head_angle / 2))
+
+        noise = self.streams.get("noise").normal(self.speeds.size).reshape(self.speeds.shape) * self.angle_noise_error
+        trailing = c_left + c_right > 0.
+
+        #SIGMOID FUNCTION
+        a = 2 / (1 + np.exp(-4 * (c_left - c_right))) - 1
+        a = np.where(trailing, a + noise, noise)
+
+        directions = rotate_vectors(self.directions, self.max_turn_angle * a * delta)
+        return directions, np.where(trailing, np.absolute(a), 0.)
+
+    def tick(self):
+        '''
+        runs the movement logic of Swarm.tick for all replicas at once
+        '''
+
+        delta = self.delta_time
+
+        #pheromone at the tails, added after all ants sensed
+        deposits = self.get_indices(self.positions - self.directions * (self.length / 2)[..., np.newaxis])
+        amounts = (100. * delta * self.speeds).ravel()
+
+        collision_vectors, evading = self.get_collision_vectors()
+        avoiding = turn_towards(self.directions, self.directions + collision_vectors, self.max_turn_angle * delta)
+        trailing, trail_change = self.trail_pheromone(delta)
+        self.directions = np.where(evading[..., np.newaxis], avoiding, trailing)
+
+        slow_down = evading | (trail_change >= self.phero_speed_down_treshold)
+        self.speeds = np.where(slow_down,
+                               np.maximum(self.speeds - self.acceleration * delta, self.min_speed),
+                               np.minimum(self.speeds + self.acceleration * delta, self.max_speed))
+
+        self.positions = self.positions + self.directions * self.speeds[..., np.newaxis] * delta
+
+        #wrap around the edges of the world
+        shift = self.dimensions / 2
+        self.positions = np.mod(self.positions + shift, self.dimensions) - shift
+
+        self.phero_map.phero_deposits.append((deposits, amounts))
+        self.phero_map.tick(delta)
+
+    def simulate(self, n):
+        for i in range(n):
+            self.tick()
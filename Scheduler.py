@@ -0,0 +1,80 @@
+from __future__ import division
+import numpy as np
+
+from Config import config
+
+
+class Stage():
+    '''
+    class Stage is a named function which runs every interval ticks
+    '''
+
+    def __init__(self, name, function, interval = 1):
+        self.name = name
+        self.function = function
+        self.interval = max(1, int(interval))
+
+        #simulated seconds since the last run
+        self.elapsed = 0.
+
+
+class Scheduler():
+    '''
+    class Scheduler runs stages in the order they were added, each at its own rate
+
+    a stage function gets the simulated seconds since its last run, so a stage which runs
+    less often can catch up. The intervals are read from the schedule section of config.yml, e.g.
+
+    schedule:
+      diffusion: 2      # diffuse every second tick
+    '''
+
+    def __init__(self, config = config):
+        self.stages = []
+        self.tick_count = 0
+
+        self.config = config
+
+    def add_stage(self, name, function, interval = None):
+        '''adds a stage, without an interval the one of the config or 1 is used'''
+        if interval is None:
+            interval = (self.config.get("schedule") or {}).get(name, 1)
+
+        stage = Stage(name, function, interval)
+        self.stages.append(stage)
+        return stage
+
+    def get_stage(self, name):
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        return None
+
+    def remove_stage(self, name):
+        self.stages = [stage for stage in self.stages if stage.name != name]
+
+    def set_interval(self, name, interval):
+        self.get_stage(name).interval = max(1, int(interval))
+
+    def get_state(self):
+        return {"tick_count": self.tick_count, "elapsed": np.array([stage.elapsed for stage in self.stages])}
+
+    def set_state(self, state):
+        self.tick_count = int(state["tick_count"])
+        for stage, elapsed in zip(self.stages, state["elapsed"]):
+            stage.elapsed = float(elapsed)
+
+    def is_due(self, stage):
+        return self.tick_count % stage.interval == 0
+
+    def tick(self, delta):
+        '''runs the stages which are due this tick'''
+        for stage in self.stages:
+            stage.elapsed += delta
+
+            if self.is_due(stage):
+                elapsed = stage.elapsed
+                stage.elapsed = 0.
+                stage.function(elapsed)
+
+        self.tick_count += 1
@@ -1,62 +1,56 @@
 from __future__ import division
-import Settings as settings
 from World import *
 from Ant import *
-import VispyView as MainView
+from Swarm import *
+from Domain import *
 from Storage import *
+from Checkpoint import *
+from LazyStorage import *
 
 import time
 import numpy as np
-import pyglet
+import os
 import sys
 
-import copy
-
 import Global as g
 
 import yaml
-
-from watchdog.observers import Observer
-from watchdog.events import LoggingEventHandler
-from watchdog.events import FileSystemEventHandler
-
-config = yaml.load(open("config.yml"))
+from Config import Config, config
 
 
-class Simulator(FileSystemEventHandler):
+class Simulator():
     '''
     This class simulates the behavior of worldobjects over time
+
+    it needs no gui or file watching modules, those are only imported by the viewer and the live mode
     '''
 
-    def __init__(self):
-        self.world = World()
-        self.avg_fps = np.zeros((200))
-        self.avg_fps_index = 0
+    def __init__(self, world = None):
+        if world is None:
+            world = World()
+        self.world = world
+
+        self.record_count = 0
+        self.keyframe_every = 0
 
     def on_modified(self, event):
-        if event.src_path == "./config.yml":
-            config = yaml.load(open("config.yml"))
+        config = self.world.config
+        if os.path.abspath(event.src_path) == config.path:
+            config.load(config.path, cached = False)
             antcount = 0
 
             self.world.delta_time = config["delta"]
 
+            #update the swarm
+            if self.world.swarm:
+                antcount += self.world.swarm.get_count()
+                self.world.swarm.set_parameters(config["ant"])
+
             #update all ants
             for wo in self.world.world_objects:
                 if isinstance(wo, Ant):
                     antcount += 1
-                    wo.max_speed = config["ant"]["max_speed"]
-                    wo.min_speed = config["ant"]["min_speed"]
-                    wo.max_turn_angle = config["ant"]["max_turn_angle"]
-                    wo.acceleration = config["ant"]["acceleration"]
-
-                    wo.length = config["ant"]["length"]
-                    wo.center_radius = config["ant"]["center_radius"]
-                    wo.head_radius = config["ant"]["head_radius"]
-                    wo.head_angle = config["ant"]["head_angle"]
-
-                    wo.signal_noise = config["ant"]["angle_noise_error"]
-
-                    wo.phero_speed_down_treshold = config["ant"]["phero_speed_down_treshold"]
+                    wo.set_parameters(config["ant"])
 
             print "changed params of " + str(antcount) + " ants."
 
@@ -66,69 +60,200 @@ class Simulator(FileSystemEventHandler):
         optional param n is the number of steps to simulate
         '''
 
-        t_start = time.clock()
+        self.run(n, report_interval = None)
+
+    def run(self, steps, record_every = 0, callback = None, report_interval = 10., start = 0):
+        '''
+        simulates steps ticks in a tight loop, e.g. for long headless runs driven by a script
+
+        callback(simulator, x) is called after tick x whenever x % record_every == 0 (x counts from 0),
+        record_every = 0 never calls it. The progress is printed every report_interval seconds of
+        wall clock time, None prints nothing. start continues a run at tick start.
+        '''
+
+        tick = self.world.tick
+
+        # ticks between two calls of the callback or two looks at the clock
+        block = record_every if record_every > 0 else 100
+
+        last_time = time.time()
+        last_x = start
+
+        x = start
+        while x < steps:
+            # the first tick of a block is followed by the callback
+            n = min(block - x % block, steps - x)
+
+            tick()
+            if record_every > 0 and callback is not None and x % block == 0:
+                callback(self, x)
+            for i in xrange(n - 1):
+                tick()
+
+            x += n
+
+            if report_interval is not None:
+                now = time.time()
+                if now - last_time >= report_interval:
+                    self.print_progress("#simulating frames... ", x, steps, (x - last_x) / (now - last_time))
+                    last_time = now
+                    last_x = x
 
-        for x in range(0,n):
-            #update the world model
-            self.world.tick()
+    def get_state(self):
+        '''returns the complete state of the simulation, see World.get_state'''
+        return {"world": self.world.get_state(),
+                "config": yaml.dump(self.world.config.to_dict()),
+                "record_count": self.record_count}
 
-    def record(self, filename, seconds, step = 1, buffer_size = 100):
+    def set_state(self, state):
+        self.world.set_state(state["world"])
+        self.record_count = int(state["record_count"])
+
+    def save_checkpoint(self, filename, x):
+        '''writes a checkpoint to continue with tick x, the recording is written to disk first so both match'''
+        if g.storage is not None:
+            g.storage.flush()
+
+        state = self.get_state()
+        state["tick"] = x
+        save_checkpoint(filename, state)
+
+    def record(self, filename, seconds, step = 1, buffer_size = 100, verbose = True, checkpoint_every = 0, resume = False, keyframe_every = 0, cache_mb = 256, compression = "lzf"):
+        '''
+        simulates seconds and records every step-th frame into filename
+
+        checkpoint_every = n writes the complete state into filename + ".checkpoint" after every n-th
+        recorded frame. resume = True continues the recording at its checkpoint, the simulator has to be
+        set up like back then (see setup_checkpoint) and seconds and step have to be the same. Without a
+        checkpoint, e.g. of a complete recording, resume raises an IOError.
+
+        keyframe_every = n only writes the complete state of every n-th frame, the frames in between
+        are simulated again when they are read (see LazyStorage)
+
+        compression is the codec of a new recording, e.g. "gzip4+shuffle" (see Storage.get_codec)
+        '''
+
+        checkpoint = filename + ".checkpoint"
+
+        if (checkpoint_every > 0 or keyframe_every > 0) and not hasattr(self.world, "get_state"):
+            print "#checkpoints and keyframes need the swarm or objects engine"
+            checkpoint_every = 0
+            keyframe_every = 0
+
+        self.keyframe_every = keyframe_every
 
         # new storage object
         groups = ["ant", "phero"]
-        shapes = [(3, len(self.world.world_objects), 2), self.world.phero_map.phero_map.shape]
+        shapes = [(3, self.world.get_ant_count(), 2), self.world.phero_map.phero_map.shape]
         dtypes = [np.float, np.float32]
-        sto = g.storage = Storage(filename, groups, shapes, dtypes, buffer_size)
+
+        # all pheromone channels as one dataset
+        stacked = isinstance(self.world.phero_map, PheromoneStack)
+        if stacked:
+            groups.append("phero_stack")
+            shapes.append(self.world.phero_map.stack.shape)
+            dtypes.append(np.float32)
+
+        # the keyframes are written into their own group instead
+        if keyframe_every > 0:
+            groups, shapes, dtypes = [], [], []
 
         #loop increment for recorded steps
-        record_count = 0
+        self.record_count = 0
+        start = 0
 
-        print "#start recording..."
+        if resume:
+            if not os.path.exists(checkpoint):
+                raise IOError("no checkpoint " + checkpoint + " to resume the recording from")
 
-        #number of steps to simulate
-        n = int(seconds / self.world.delta_time)
-        for x in range(n):
-	    start = time.clock()
-            self.world.tick()
+            state = load_checkpoint(checkpoint)
+            self.set_state(state)
+            start = int(state["tick"])
 
-            if x % step == 0:
-                sto.set("ant", record_count, self.world.world_objects_to_numpy())
-                sto.set("phero", record_count, self.world.phero_map.phero_map)
+            # frames recorded after the checkpoint are simulated again
+            sto = g.storage = Storage(filename, buffer_size=buffer_size, cache_mb=cache_mb)
+            sto.truncate(self.record_count)
 
-                record_count += 1
+            if "keyframes" in sto.file:
+                for name in list(sto.file["keyframes"].keys()):
+                    if int(name) >= self.record_count:
+                        del sto.file["keyframes"][name]
 
+            if verbose:
+                print "#resuming at frame " + str(self.record_count) + "..."
+        else:
+            sto = g.storage = Storage(filename, groups, shapes, dtypes, buffer_size, compression, cache_mb=cache_mb)
 
-            fps = int(1 / (time.clock() - start))
+            if verbose:
+                print "#start recording..."
 
-            if self.avg_fps[0] == 0:
-                self.avg_fps.fill(fps)
-            else:
-                self.avg_fps[self.avg_fps_index] = fps
-                if self.avg_fps_index + 1 > len(self.avg_fps) - 1:
-                    self.avg_fps_index = 0
-                else:
-                    self.avg_fps_index += 1
+        #number of steps to simulate
+        n = int(seconds / self.world.delta_time)
 
-            self.print_progress("#simulating frames... ", x, n, np.average(self.avg_fps))
+        def on_frame(simulator, x):
+            self.record_frame()
+            if checkpoint_every > 0 and self.record_count % checkpoint_every == 0:
+                self.save_checkpoint(checkpoint, x + 1)
 
+        self.run(n, step, on_frame, 10. if verbose else None, start)
 
-        print "#simulated " + str(n) + " frames."
-        print "#recorded " + str(record_count) + " frames."
+        if verbose:
+            print ""
+            print "#simulated " + str(n) + " frames."
+            print "#recorded " + str(self.record_count) + " frames."
 
         sto.keyval_set("version", "0.4")
-        sto.keyval_set("frame_count", record_count)
+        sto.keyval_set("frame_count", self.record_count)
         sto.keyval_set("record_step", step)
 
         sto.keyval_set("world_dimensions", self.world.dimensions)
         sto.keyval_set("world_delta_time", self.world.delta_time)
 
         sto.keyval_set("phero_resolution", self.world.phero_map.resolution)
+        if stacked:
+            sto.keyval_set("phero_channels", self.world.phero_map.channels)
         sto.keyval_set("ant_count", self.world.get_ant_count() )
+        # the seed and the config regenerate the recording
+        sto.keyval_set("seed", self.world.streams.seed)
+        sto.keyval_set("config", yaml.dump(self.world.config.to_dict()))
+        if isinstance(self.world, DomainWorld):
+            sto.keyval_set("engine", "domain")
+        else:
+            sto.keyval_set("engine", "swarm" if self.world.swarm else "objects")
+        sto.keyval_set("keyframe_every", keyframe_every)
 
         # write remaining changes to disk
         sto.store()
 
-        print "#all done!"
+        # the recording is complete
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+        if verbose:
+            print "#all done!"
+
+    def record_frame(self):
+        sto = g.storage
+
+        if self.keyframe_every > 0:
+            if self.record_count % self.keyframe_every == 0:
+                keyframes = sto.file.require_group("keyframes")
+                write_state(keyframes.create_group(str(self.record_count)), self.get_state())
+
+            self.record_count += 1
+            return
+
+        self.set_frame("ant", self.world.world_objects_to_numpy())
+        self.set_frame("phero", self.world.phero_map.phero_map)
+        if isinstance(self.world.phero_map, PheromoneStack):
+            self.set_frame("phero_stack", self.world.phero_map.stack)
+
+        self.record_count += 1
+
+    def set_frame(self, group, frame):
+        '''sets the frame record_count of group, a frame which doesn't fit the recording raises a ValueError'''
+        if not g.storage.set(group, self.record_count, frame):
+            raise ValueError("frame " + str(self.record_count) + " of " + group + " with shape " + str(frame.shape) + " doesn't fit the recording")
 
     def print_progress(self, label, x, max, fps):
         perc = (x / max)
@@ -139,25 +264,77 @@ class Simulator(FileSystemEventHandler):
 
 
 
-def create_random_objects(n, dimension):
+def setup_checkpoint(filename):
+    '''
+    returns a simulator set up with the config and the ants of the checkpoint filename,
+    record(resume = True) continues from the checkpoint itself
+    '''
+
+    state = load_checkpoint(filename)
+    checkpoint_config = Config(yaml.load(str(state["config"])))
+
+    world = state["world"]
+    if "swarm" in world:
+        return setup(len(world["swarm"]["speeds"]), "swarm", config = checkpoint_config)
+    return setup(len(world["objects"]["speeds"]), "objects", config = checkpoint_config)
+
+def watch_config(simulator):
+    '''
+    calls simulator.on_modified whenever a file in the working directory changes, returns the running observer
+    '''
+
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+
+    class ConfigHandler(FileSystemEventHandler):
+        def on_modified(self, event):
+            simulator.on_modified(event)
+
+    observer = Observer()
+    observer.schedule(ConfigHandler(), path='.', recursive=False)
+    observer.start()
+    return observer
+
+def create_random_objects(n, dimension, stream, config = config):
     '''
-    returns a list of n antobjects with random position and direction vectors
+    returns a list of n antobjects with random position and direction vectors drawn from stream
     '''
 
     #returns n objects with position between (10,10) and (390,390)
-    return [Ant( np.random.uniform(-1,1, (2)) * dimension, np.random.uniform(-1,1, (2)) ) for a in range(0,n)]
+    return [Ant( stream.uniform(-1,1, (2)) * dimension, stream.uniform(-1,1, (2)), config = config ) for a in range(0,n)]
 
-def setup(n = 100):
+def create_random_swarm(n, dimension, stream, config = config):
+    '''
+    returns a swarm of n ants with random position and direction vectors drawn from stream
+    '''
+
+    return Swarm( stream.uniform(-1,1, (n,2)) * dimension, stream.uniform(-1,1, (n,2)), config = config )
+
+def setup(n = 100, engine = "swarm", workers = 2, seed = None, config = config):
     '''
     this is the startup function which initializes a Simulator-Object and loads the settings file
     n = number of elements to create
+    engine = "swarm" ticks all ants at once as arrays, "objects" ticks every Ant object on its own,
+             "domain" splits the world into strips simulated by worker processes
+    workers = number of worker processes of the domain engine
+    seed = seed of all random streams of the simulation, None draws a new one
+    config = settings of the simulation, the ones of config.yml by default
     '''
 
+    streams = RandomStreams(seed)
+
+    if engine == "domain":
+        dimensions = np.array(config["world_dimension"])
+        return Simulator(DomainWorld(create_random_swarm(n, dimensions, streams.get("setup"), config), workers, streams.seed, config))
+
     #creates a simulator instance
-    s = Simulator()
+    s = Simulator(World(streams = streams, config = config))
 
     #add some ants
-    s.world.add_objects( create_random_objects(n, s.world.dimensions) )
+    if engine == "swarm":
+        s.world.set_swarm( create_random_swarm(n, s.world.dimensions, streams.get("setup"), config) )
+    else:
+        s.world.add_objects( create_random_objects(n, s.world.dimensions, streams.get("setup"), config) )
 
     return s
 
@@ -174,8 +351,19 @@ if __name__ == "__main__":
     record_time = 5.
     record_step = 10
     ant_count = 20
+    engine = "swarm"
+    workers = 2
 
     buffer_size = 100
+    prefetch_depth = 1
+    cache_mb = 256
+    codec = "lzf"
+    keyframe_every = 0
+    config_path = None
+
+    checkpoint_every = 0
+    resume = False
+    seed = None
 
     i=1
     while i < len(sys.argv):
@@ -198,9 +386,38 @@ if __name__ == "__main__":
         elif sys.argv[i] == "-ac":
             ant_count = int(sys.argv[i+1])
             i += 1
+        elif sys.argv[i] == "-e":
+            engine = sys.argv[i+1]
+            i += 1
+        elif sys.argv[i] == "-w":
+            workers = int(sys.argv[i+1])
+            i += 1
         elif sys.argv[i] == "-bs":
             buffer_size = int(sys.argv[i+1])
             i += 1
+        elif sys.argv[i] == "-pf":
+            prefetch_depth = int(sys.argv[i+1])
+            i += 1
+        elif sys.argv[i] == "-cache-mb":
+            cache_mb = float(sys.argv[i+1])
+            i += 1
+        elif sys.argv[i] == "-codec":
+            codec = sys.argv[i+1]
+            i += 1
+        elif sys.argv[i] == "-c":
+            config_path = sys.argv[i+1]
+            i += 1
+        elif sys.argv[i] == "-kf":
+            keyframe_every = int(sys.argv[i+1])
+            i += 1
+        elif sys.argv[i] == "-cp":
+            checkpoint_every = int(sys.argv[i+1])
+            i += 1
+        elif sys.argv[i] == "-seed":
+            seed = int(sys.argv[i+1])
+            i += 1
+        elif sys.argv[i] == "-resume":
+            resume = True
         elif sys.argv[i] == "-live":
             live = True
             g.live = live
@@ -209,23 +426,33 @@ if __name__ == "__main__":
 
         i += 1
 
+    if config_path is not None:
+        config.load(config_path)
+
     if record:
-        g.simulator = setup(ant_count)
+        if resume and not os.path.exists(filename + ".checkpoint"):
+            print "#no checkpoint to resume " + filename + " from"
+            sys.exit(1)
+
+        if resume:
+            g.simulator = setup_checkpoint(filename + ".checkpoint")
+        else:
+            g.simulator = setup(ant_count, engine, workers, seed)
 
         if not live:
-            g.simulator.record(filename, record_time, record_step, buffer_size)
+            g.simulator.record(filename, record_time, record_step, buffer_size, checkpoint_every = checkpoint_every, resume = resume, keyframe_every = keyframe_every, cache_mb = cache_mb, compression = codec)
+
+        if engine == "domain":
+            g.simulator.world.close()
 
     if view:
         if not live:
-            g.storage = Storage(filename, buffer_size=buffer_size)
+            g.storage = open_recording(filename, buffer_size, prefetch_depth = prefetch_depth, cache_mb = cache_mb)
         if not record and live:
-            g.simulator = setup(ant_count)
-            event_handler = g.simulator
-            observer = Observer()
-            observer.schedule(event_handler, path='.', recursive=False)
-            observer.start()
-
+            g.simulator = setup(ant_count, engine, workers, seed)
+            observer = watch_config(g.simulator)
 
+        import VispyView as MainView
         MainView.start_view(view_fps)
 
         if not record and live:
@@ -0,0 +1,281 @@
+from __future__ import division
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class NeighbourIndex():
+    '''
+    class NeighbourIndex finds neighbours of positions on the toroidal world
+
+    distances wrap around the borders of the world, queries return the indices of the indexed positions
+    '''
+
+    def __init__(self, dimensions):
+        self.dimensions = np.array(dimensions, dtype=np.float)
+        self.positions = np.empty((0, 2), dtype=np.float)
+
+    def wrap(self, positions):
+        '''shifts world coordinates into [0, dimensions)'''
+        wrapped = np.mod(positions + self.dimensions / 2, self.dimensions)
+        # mod can round tiny negative values up to the dimension itself
+        wrapped[wrapped >= self.dimensions] = 0.
+        return wrapped
+
+    def get_difference(self, v1, v2):
+        '''returns the shortest vector from v2 to v1 on the torus'''
+        diff = v1 - v2
+        return diff - self.dimensions * np.round(diff / self.dimensions)
+
+    def update(self, positions):
+        '''
+        this will be overwritten by child classes
+        '''
+        self.positions = np.array(positions, dtype=np.float).reshape((-1, 2))
+
+    def get_state(self):
+        '''returns the arrays the index was built from, set_state restores the very same index'''
+        return {"positions": self.positions}
+
+    def set_state(self, state):
+        self.update(state["positions"])
+
+    def query(self, positions, radius):
+        '''returns (rows, cols) so that the indexed position cols[k] is within radius of positions[rows[k]]
+
+        this will be overwritten by child classes
+        '''
+        return np.empty(0, dtype=np.int), np.empty(0, dtype=np.int)
+
+    def query_pairs(self, radius):
+        '''returns (rows, cols) of all pairs of indexed positions within radius, without the pairs of a position with itself'''
+        rows, cols = self.query(self.positions, radius)
+        others = rows != cols
+        return rows[others], cols[others]
+
+
+class PeriodicKDTree(NeighbourIndex):
+    '''
+    class PeriodicKDTree is a kd tree which is rebuilt from all positions on every update
+    '''
+
+    def __init__(self, dimensions, leafsize = 50):
+        NeighbourIndex.__init__(self, dimensions)
+        self.leafsize = leafsize
+
+        self.tree = None
+
+    def update(self, positions):
+        NeighbourIndex.update(self, positions)
+
+        if len(self.positions) == 0:
+            self.tree = None
+        else:
+            self.tree = cKDTree(self.wrap(self.positions), self.leafsize, boxsize=self.dimensions)
+
+    def query(self, positions, radius):
+        if self.tree is None or len(positions) == 0:
+            return NeighbourIndex.query(self, positions, radius)
+
+        indices = self.tree.query_ball_point(self.wrap(positions), radius)
+
+        # flatten the neighbour lists into (row, column) pairs
+        counts = np.array([len(i) for i in indices], dtype=np.int)
+        rows = np.repeat(np.arange(len(positions)), counts)
+        cols = np.fromiter((j for i in indices for j in i), dtype=np.int, count=counts.sum())
+
+        return rows, cols
+
+    def query_pairs(self, radius):
+        if self.tree is None:
+            return NeighbourIndex.query_pairs(self, radius)
+
+        # every pair once, i < j
+        pairs = self.tree.query_pairs(radius, output_type="ndarray")
+
+        # both directions, not sorted by rows like the pairs of query
+        rows = np.concatenate((pairs[:, 0], pairs[:, 1]))
+        cols = np.concatenate((pairs[:, 1], pairs[:, 0]))
+
+        return rows, cols
+
+
+class CellList(NeighbourIndex):
+    '''
+    class CellList hashes the positions into a uniform grid of cells which are at least cell_size wide
+
+    on update only the positions which changed their cell are moved, queries look at the
+    surrounding cells and wrap around the borders of the world
+    '''
+
+    def __init__(self, dimensions, cell_size):
+        NeighbourIndex.__init__(self, dimensions)
+
+        # number of cells per axis
+        self.shape = np.maximum(1, np.floor(self.dimensions / cell_size)).astype(np.int)
+        self.cell_size = self.dimensions / self.shape
+
+        # cell id of every position
+        self.cells = np.empty(0, dtype=np.int)
+        # position indices sorted by cell
+        self.order = np.empty(0, dtype=np.int)
+        # number of positions per cell and offset of every cell in order
+        self.counts = np.zeros(np.prod(self.shape), dtype=np.int)
+        self.start = np.zeros(np.prod(self.shape) + 1, dtype=np.int)
+
+    def get_cell_coordinates(self, positions):
+        cell = (self.wrap(positions) / self.cell_size).astype(np.int)
+        # rounding can put positions right below the border into a cell too far
+        return np.minimum(cell, self.shape - 1)
+
+    def get_cells(self, positions):
+        cell = self.get_cell_coordinates(positions)
+        return cell[:, 0] * self.shape[1] + cell[:, 1]
+
+    def update(self, positions):
+        NeighbourIndex.update(self, positions)
+
+        cells = self.get_cells(self.positions)
+
+        if len(cells) != len(self.cells):
+            self.order = np.argsort(cells, kind="mergesort")
+            self.counts = np.bincount(cells, minlength=len(self.counts))
+        else:
+            changed = np.flatnonzero(cells != self.cells)
+            if len(changed) > 0:
+                self.rebin(changed, cells)
+
+        self.cells = cells
+        self.start[1:] = np.cumsum(self.counts)
+
+    def rebin(self, changed, cells):
+        '''moves the positions changed from their old into their new cells'''
+
+        moved = np.zeros(len(cells), dtype=bool)
+        moved[changed] = True
+
+        # all remaining positions keep their cell, so order stays sorted
+        order = self.order[~moved[self.order]]
+
+        changed = changed[np.argsort(cells[changed], kind="mergesort")]
+        slots = np.searchsorted(cells[order], cells[changed], side="right")
+        self.order = np.insert(order, slots, changed)
+
+        self.counts -= np.bincount(self.cells[changed], minlength=len(self.counts))
+        self.counts += np.bincount(cells[changed], minlength=len(self.counts))
+
+    def get_state(self):
+        # the order of the positions in their cells depends on the past updates
+        return {"positions": self.positions, "cells": self.cells, "order": self.order, "counts": self.counts}
+
+    def set_state(self, state):
+        self.positions = np.array(state["positions"], dtype=np.float).reshape((-1, 2))
+        self.cells = np.array(state["cells"], dtype=np.int)
+        self.order = np.array(state["order"], dtype=np.int)
+        self.counts[...] = state["counts"]
+        self.start[1:] = np.cumsum(self.counts)
+
+    def get_neighbour_cells(self, positions, radius):
+        '''returns the ids of all cells within radius of every position as (M, K) array'''
+
+        reach = np.ceil(radius / self.cell_size).astype(np.int)
+
+        # offsets which wrap onto the same cell are only visited once
+        offsets_x = np.unique(np.arange(-reach[0], reach[0] + 1) % self.shape[0])
+        offsets_y = np.unique(np.arange(-reach[1], reach[1] + 1) % self.shape[1])
+
+        cell = self.get_cell_coordinates(positions)
+        x = (cell[:, 0, np.newaxis] + offsets_x) % self.shape[0]
+        y = (cell[:, 1, np.newaxis] + offsets_y) % self.shape[1]
+
+        return (x[:, :, np.newaxis] * self.shape[1] + y[:, np.newaxis, :]).reshape((len(positions), -1))
+
+    def query(self, positions, radius):
+        if len(self.positions) == 0 or len(positions) == 0:
+            return NeighbourIndex.query(self, positions, radius)
+
+        neighbour_cells = self.get_neighbour_cells(positions, radius)
+        queries = np.repeat(np.arange(len(positions)), neighbour_cells.shape[1])
+        neighbour_cells = neighbour_cells.ravel()
+
+        # expand every (position, cell) pair into the positions of the cell
+        counts = self.counts[neighbour_cells]
+        rows = np.repeat(queries, counts)
+        first = np.repeat(self.start[neighbour_cells] - (np.cumsum(counts) - counts), counts)
+        cols = self.order[first + np.arange(counts.sum())]
+
+        diff = self.get_difference(positions[rows], self.positions[cols])
+        in_range = np.sum(diff * diff, axis=1) <= radius * radius
+
+        return rows[in_range], cols[in_range]
+
+
+class VerletList(NeighbourIndex):
+    '''
+    class VerletList caches the pairs within radius + skin of another neighbour index
+
+    the index is only rebuilt when a position moved further than half the skin since the last
+    build, until then the cached pairs contain all pairs within radius
+    '''
+
+    def __init__(self, index, radius, skin):
+        NeighbourIndex.__init__(self, index.dimensions)
+        self.index = index
+        self.radius = radius
+        self.skin = skin
+
+        # positions at the last build and the cached pairs
+        self.build_positions = None
+        self.rows = np.empty(0, dtype=np.int)
+        self.cols = np.empty(0, dtype=np.int)
+
+        self.build_count = 0
+
+    def get_max_displacement(self):
+        displacement = self.get_difference(self.positions, self.build_positions)
+        return np.sqrt(np.max(np.sum(displacement * displacement, axis=1)))
+
+    def update(self, positions):
+        NeighbourIndex.update(self, positions)
+
+        if self.build_positions is None or len(self.positions) != len(self.build_positions) or \
+                (len(self.positions) > 0 and self.get_max_displacement() > self.skin / 2):
+            self.build()
+
+    def get_state(self):
+        state = {"positions": self.positions, "rows": self.rows, "cols": self.cols,
+                 "build_count": self.build_count, "index": self.index.get_state()}
+        if self.build_positions is not None:
+            state["build_positions"] = self.build_positions
+        return state
+
+    def set_state(self, state):
+        self.positions = np.array(state["positions"], dtype=np.float).reshape((-1, 2))
+        self.build_positions = state.get("build_positions")
+        self.rows = np.array(state["rows"], dtype=np.int)
+        self.cols = np.array(state["cols"], dtype=np.int)
+        self.build_count = int(state["build_count"])
+        self.index.set_state(state["index"])
+
+    def build(self):
+        self.build_positions = self.positions
+        self.index.update(self.positions)
+        self.rows, self.cols = self.index.query_pairs(self.radius + self.skin)
+        self.build_count += 1
+
+    def query(self, positions, radius):
+        # nothing moved further than half the skin since the index was built
+        rows, cols = self.index.query(positions, radius + self.skin / 2)
+
+        diff = self.get_difference(positions[rows], self.positions[cols])
+        in_range = np.sum(diff * diff, axis=1) <= radius * radius
+
+        return rows[in_range], cols[in_range]
+
+    def query_pairs(self, radius):
+        if radius > self.radius:
+            return NeighbourIndex.query_pairs(self, radius)
+
+        diff = self.get_difference(self.positions[self.rows], self.positions[self.cols])
+        in_range = np.sum(diff * diff, axis=1) <= radius * radius
+
+        return self.rows[in_range], self.cols[in_range]
@@ -1,5 +1,7 @@
 import numpy as np
-import h5py
+import collections
+import Queue
+import sys
 import threading
 
 def test(n):
@@ -13,8 +15,78 @@ def test(n):
 
     return s
 
+def test_chunks(shape = (5000, 5000), dtype = np.float32):
+    '''checks that the chunks of a frame larger than max_chunk_mb fit into it'''
+    chunks = get_chunks(shape, dtype, 100)
+    chunk_bytes = int(np.prod(chunks)) * np.dtype(dtype).itemsize
+
+    assert chunks[0] == 1
+    assert chunk_bytes <= max_chunk_mb * 1024 * 1024, chunks
+
+    return chunks
+
+# largest chunk, the chunks of a block are made smaller when it is larger
+max_chunk_mb = 4
+
+# prints every block which is read or written, mostly by the background threads
+verbose = False
+
+def get_codec(name):
+    '''
+    returns the hdf5 filter arguments of a codec name
+
+    "none", "lzf" or "gzip" with an optional level, e.g. "gzip6" (default 4), "+shuffle" shuffles the
+    bytes of the values before compressing them, e.g. "gzip1+shuffle"
+    '''
+    parts = (name or "none").split("+")
+    codec = {"compression": None, "compression_opts": None, "shuffle": "shuffle" in parts[1:]}
+
+    if parts[0] == "lzf":
+        codec["compression"] = "lzf"
+    elif parts[0].startswith("gzip"):
+        codec["compression"] = "gzip"
+        codec["compression_opts"] = int(parts[0][4:] or 4)
+    elif parts[0] != "none":
+        print("Storage: unknown codec " + name + ", not compressing")
+
+    return codec
+
+def get_chunks(shape, dtype, buffer_size):
+    '''returns the chunk shape of a group, one chunk holds the frames of a block or an equal part of them'''
+    frame_bytes = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+
+    max_bytes = max_chunk_mb * 1024 * 1024
+
+    frames = buffer_size
+    while frames > 1 and (frames * frame_bytes > max_bytes or buffer_size % frames != 0):
+        frames -= 1
+
+    # a single frame which is too large is split along its largest axes
+    chunk = [int(d) for d in shape]
+    while chunk and max(chunk) > 1 and int(np.prod(chunk)) * np.dtype(dtype).itemsize > max_bytes:
+        i = int(np.argmax(chunk))
+        chunk[i] = (chunk[i] + 1) // 2
+
+    return (frames,) + tuple(chunk)
+
 class Storage():
-    def __init__(self, file_name, groups = [], shapes = [], dtypes = [], buffer_size = 100, compression = "lzf"):
+    '''
+    class Storage keeps the frames of a recording in a hdf5 file, blocks of buffer_size frames at a time in ram
+
+    the blocks are kept in a LRU cache of at most cache_mb megabytes, a block is made smaller than
+    buffer_size frames when the frames are too large for a few of them to fit. A changed block is
+    written behind by a background thread when it is evicted, at most queue_size blocks wait for it
+    before set blocks. An error of the writer is raised by the next set or store.
+
+    while frames are read one block after the other, the next prefetch_depth blocks in that direction
+    are read ahead by another background thread, so get only waits for a block which is not read yet.
+
+    a new file is compressed with the codec compression (see get_codec). chunks holds the chunk shape
+    of each group, None aligns the chunks with the blocks (see get_chunks), True lets h5py choose.
+    '''
+
+    def __init__(self, file_name, groups = [], shapes = [], dtypes = [], buffer_size = 100, compression = "lzf", queue_size = 2, prefetch_depth = 1, cache_mb = 256, chunks = None):
+        import h5py
         self.file = h5py.File(file_name, "a")
         self.groups = groups
         self.shapes = shapes
@@ -22,36 +94,82 @@ class Storage():
 
         self.buffer_size = buffer_size
 
+        # buffers of the cached blocks by id, least recently used first
+        self.blocks = collections.OrderedDict()
         self.current_id = -1
         self.buffer = {}
-        self.buffer_next = {}
-        self.buffer_prev = {}
+
+        # arrays of released buffers by group, reused instead of allocating new ones
+        self.free = {}
+        # (group, id) of the buffers waiting for the writer
+        self.pending = set()
+
+        self.writer = BufferWriter(queue_size, self.free, self.pending)
+        self.writer.start()
+
+        self.prefetch_depth = prefetch_depth
+        # 1 while the frames are accessed forwards, -1 backwards
+        self.direction = 1
+        # ids of the blocks read ahead
+        self.ahead = []
+        self.reader = BufferReader()
+        self.reader.start()
 
         self.length = 0
 
-        if "buffer" in self.file and "keyval" in self.file:
+        recalled = "buffer" in self.file and "keyval" in self.file
+
+        if recalled:
             print("Storage: recalling " + file_name)
 
             self.length = self.file["buffer"].attrs["length"]
 
             self.groups = self.file["buffer"].attrs["groups"]
-            self.shapes = [None] * len(self.groups)
-            self.dtypes = [None] * len(self.groups)
-        else:
+            # frames can be appended to a recalled file, e.g. to continue a recording
+            self.shapes = [self.file["buffer"][name].shape[1:] for name in self.groups]
+            self.dtypes = [self.file["buffer"][name].dtype for name in self.groups]
+
+        # the blocks are sized before the chunks are aligned with them
+        self.set_cache_size(cache_mb)
+
+        if not recalled:
             print("Storage: creating " + file_name)
             self.file.create_group("buffer")
             self.file.create_group("keyval")
 
+            codec = get_codec(compression)
             for i in range(len(self.groups)):
+                group_chunks = chunks[i] if chunks is not None else None
+                if group_chunks is None:
+                    group_chunks = get_chunks(self.shapes[i], self.dtypes[i], self.buffer_size)
+
                 maxshape = (None,) * (len(self.shapes[i]) + 1)
-                self.file["buffer"].create_dataset(self.groups[i], (0,) + self.shapes[i], self.dtypes[i], chunks=True, maxshape=maxshape, compression = compression)
+                self.file["buffer"].create_dataset(self.groups[i], (0,) + tuple(self.shapes[i]), self.dtypes[i], chunks=group_chunks, maxshape=maxshape, **codec)
 
         self.recall(0)
         return
 
     def __del__(self):
+        self.close()
+
+    def close(self):
+        '''waits for the writer and closes the file, frames which were not stored are lost'''
+        self.reader.stop()
+        self.writer.stop()
         self.file.close()
 
+    def set_cache_size(self, cache_mb):
+        '''fits the blocks into cache_mb, the current block and the ones read ahead need to fit at least'''
+        frame_bytes = sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for shape, dtype in zip(self.shapes, self.dtypes))
+        cache_bytes = int(cache_mb * 1024 * 1024)
+        min_blocks = self.prefetch_depth + 1
+
+        if frame_bytes > 0:
+            self.buffer_size = max(1, min(self.buffer_size, cache_bytes // (frame_bytes * min_blocks)))
+
+        block_bytes = max(1, frame_bytes * self.buffer_size)
+        self.max_blocks = max(min_blocks, cache_bytes // block_bytes)
+
     def keyval_set(self, key, val):
         self.file["keyval"].attrs[key] = val
         return
@@ -60,6 +178,8 @@ class Storage():
         return self.file["keyval"].attrs[key]
 
     def set(self, group, index, val):
+        self.writer.check()
+
         if index < 0 or index > self.length:
             return False
 
@@ -88,81 +208,149 @@ class Storage():
         if id == self.current_id:
             return True
 
-        if id == self.current_id + self.buffer_size:
-            if self.buffer_prev:
-                for name in self.groups:
-                    self.buffer_prev[name].store()
-            self.buffer_prev = self.buffer
-            self.buffer = self.buffer_next
-            self.buffer_next = {}
-        elif id == self.current_id - self.buffer_size:
-            if self.buffer_next:
-                for name in self.groups:
-                    self.buffer_next[name].store()
-            self.buffer_next = self.buffer
-            self.buffer = self.buffer_prev
-            self.buffer_prev = {}
+        # frames read one block after the other are read ahead, random seeks are not
+        sequential = self.current_id < 0 or abs(id - self.current_id) == self.buffer_size
+
+        if self.current_id >= 0:
+            self.direction = 1 if id > self.current_id else -1
+
+        if id in self.blocks:
+            # most recently used blocks are at the end
+            self.blocks[id] = self.blocks.pop(id)
         else:
-            if self.buffer_prev:
-                for name in self.groups:
-                    self.buffer_prev[name].store()
-            self.buffer_prev = {}
-            if self.buffer:
-                for name in self.groups:
-                    self.buffer[name].store()
-            self.buffer = {}
-            if self.buffer_next:
-                for name in self.groups:
-                    self.buffer_next[name].store()
-            self.buffer_next = {}
+            self.blocks[id] = self.load(id)
 
         self.current_id = id
+        self.buffer = self.blocks[id]
 
-        if not self.buffer_prev and id - self.buffer_size >= 0:
-            for i in range(len(self.groups)):
-                self.buffer_prev[self.groups[i]] = Buffer(self.file, self.groups[i], id - self.buffer_size, self.buffer_size, self.shapes[i], self.dtypes[i])
-        if not self.buffer and id >= 0:
-            for j in range(len(self.groups)):
-                self.buffer[self.groups[j]] = Buffer(self.file, self.groups[j], id, self.buffer_size, self.shapes[j], self.dtypes[j])
-        if not self.buffer_next and id + self.buffer_size >= 0:
-            for k in range(len(self.groups)):
-                self.buffer_next[self.groups[k]] = Buffer(self.file, self.groups[k], id + self.buffer_size, self.buffer_size, self.shapes[k], self.dtypes[k])
+        self.prefetch(id, self.prefetch_depth if sequential else 0)
+        self.evict()
 
         return True
 
+    def load(self, id):
+        '''returns the buffers of the block starting at id, prefetched ones are taken from the reader'''
+        if id in self.reader.blocks:
+            return self.reader.take(id)
+
+        return self.create_buffers(id)
+
+    def prefetch(self, id, depth):
+        '''hands the next depth blocks in the current direction to the reader'''
+        depth = min(depth, self.max_blocks - 1)
+        ids = [id + self.direction * self.buffer_size * k for k in range(1, depth + 1)]
+        ids = [i for i in ids if 0 <= i < self.length]
+
+        # blocks read ahead in the other direction are not needed anymore
+        for other in list(self.reader.blocks.keys()):
+            if other not in ids:
+                self.release(self.reader.take(other, wait = False))
+
+        self.ahead = ids
+        for i in ids:
+            if i in self.reader.blocks or i in self.blocks or self.is_pending(i):
+                continue
+            self.reader.put(i, self.create_buffers(i, read = False))
+
+    def evict(self):
+        '''releases the least recently used blocks until the cached and prefetched blocks fit'''
+        for id in list(self.blocks.keys()):
+            if len(self.blocks) + len(self.reader.blocks) <= self.max_blocks:
+                break
+            # neither the current block nor the ones ahead of it
+            if id != self.current_id and id not in self.ahead:
+                self.release(self.blocks.pop(id))
+
+    def is_pending(self, id):
+        return any((name, id) in self.pending for name in self.groups)
+
+    def create_buffers(self, id, read = True):
+        # a block which is still being written is read after the writer is done with it
+        if read and self.is_pending(id):
+            self.writer.wait()
+
+        buffers = {}
+        for i in range(len(self.groups)):
+            name = self.groups[i]
+            array = self.free[name].pop() if self.free.get(name) else None
+            buffers[name] = Buffer(self.file, name, id, self.buffer_size, self.shapes[i], self.dtypes[i], array, read)
+        return buffers
+
+    def release(self, buffers):
+        '''hands changed buffers to the writer, the arrays are reused for the next buffers of their group'''
+        if any(buffer.changed for buffer in buffers.values()):
+            self.writer.put(buffers)
+        else:
+            for name, buffer in buffers.items():
+                self.free.setdefault(name, []).append(buffer.buffer)
+
     def store(self):
+        self.writer.wait()
+        self.writer.check()
+
         # save relevant fields for recall
         self.file["buffer"].attrs["length"] = self.length
         self.file["buffer"].attrs["groups"] = self.groups
 
         # write remainig data to disk
-        if self.buffer_prev:
+        for buffers in self.blocks.values():
             for name in self.groups:
-                self.buffer_prev[name].store()
-        if self.buffer:
-            for name in self.groups:
-                self.buffer[name].store()
-        if self.buffer_next:
-            for name in self.groups:
-                self.buffer_next[name].store()
+                buffers[name].store()
 
         return
 
+    def flush(self):
+        '''writes everything to disk, the blocks are recalled from the file on their next access'''
+        self.store()
+        self.file.flush()
+
+        for buffers in self.blocks.values():
+            self.release(buffers)
+        for id in list(self.reader.blocks.keys()):
+            self.release(self.reader.take(id))
+
+        self.blocks = collections.OrderedDict()
+        self.current_id = -1
+        self.buffer = {}
+
+    def truncate(self, length):
+        '''drops all frames from length on, e.g. the frames recorded after the last checkpoint'''
+        self.flush()
+
+        for name in self.groups:
+            dset = self.file["buffer"][name]
+            if dset.shape[0] > length:
+                dset.resize(length, axis=0)
+            length = min(length, dset.shape[0])
+
+        self.length = length
+        self.file["buffer"].attrs["length"] = self.length
+
+        self.recall(0)
+
 
 class Buffer():
-    def __init__(self, file, name, id, size, shape, dtype):
-        self.thread = None
+    '''
+    class Buffer holds the frames id to id + size of a group in one (size, *shape) array
+
+    the frames are read into the array and written back from it in one piece. get returns a view
+    into the array, copy it to keep it after the buffer was stored, the array is reused by the
+    next buffer of the group.
+    '''
 
+    def __init__(self, file, name, id, size, shape, dtype, array = None, read = True):
         self.id = id
         self.name = name
-        self.shape = shape
-        self.dtype = dtype
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
         self.size = size
 
         if not self.name in file["buffer"]:
             print("Storage: critical error")
 
-        self.buffer = None
+        if array is None or array.shape != (size,) + self.shape or array.dtype != self.dtype:
+            array = np.empty((size,) + self.shape, dtype=self.dtype)
+        self.buffer = array
         self.changed = False
 
         self.dset = file["buffer"][self.name]
@@ -170,41 +358,45 @@ class Buffer():
         super_length = self.dset.shape[0]
         self.length = min(max(0, super_length - self.id), self.size)
 
-        self.recall()
+        if read:
+            self.recall()
 
         return
 
     def recall(self):
-        if self.buffer:
-            return True
+        self.length = min(self.size, max(0, self.dset.shape[0] - self.id))
 
         if self.length != 0:
-            print("Storage: recalling " + self.name + "[" + str(self.id) + ":" + str(self.id + self.length) + "]")
+            if verbose:
+                print("Storage: recalling " + self.name + "[" + str(self.id) + ":" + str(self.id + self.length) + "]")
 
-        '''if self.thread:
-            self.thread.join()
-        self.thread = BufferReader(self)
-        self.thread.start()'''
-        reader = BufferReader(self)
-        reader.run()
+            # straight into the array, without a temporary array per read
+            self.dset.read_direct(self.buffer, np.s_[self.id:self.id + self.length], np.s_[0:self.length])
+
+        self.changed = False
 
         return True
 
     def store(self):
-        if not self.buffer:
-            return True
-
         if self.changed:
-            print("Storage: storing " + self.name + "[" + str(self.id) + ":" + str(self.id + self.length) + "]")
-            '''if self.thread:
-                self.thread.join()
-            self.thread = BufferWriter(self)
-            self.thread.start()'''
-            writer = BufferWriter(self)
-            writer.run()
+            self.write()
 
         return True
 
+    def write(self):
+        if verbose:
+            print("Storage: storing " + self.name + "[" + str(self.id) + ":" + str(self.id + self.length) + "]")
+
+        super_length = self.dset.shape[0]
+        if super_length < self.id + self.length:
+            self.dset.resize(self.id + self.length, axis=0)
+
+        if self.length > 0:
+            # one hyperslab for all frames
+            self.dset.write_direct(self.buffer, np.s_[0:self.length], np.s_[self.id:self.id + self.length])
+
+        self.changed = False
+
 
     def set(self, index, val):
         if index < 0 or index >= self.size or index > self.length:
@@ -213,13 +405,7 @@ class Buffer():
         if self.shape != val.shape:
             return False
 
-        if not self.buffer:
-            return False
-
-        if self.thread:
-            self.thread.join()
-            self.thread = None
-
+        # copies, the caller may reuse its array
         self.buffer[index] = val
         self.changed = True
 
@@ -229,54 +415,135 @@ class Buffer():
         return True
 
     def get(self, index):
-        if index < 0 or index > self.length:
-            return None
-
-        if not self.buffer:
+        if index < 0 or index >= self.length:
             return None
 
-        if self.thread:
-            self.thread.join()
-            self.thread = None
-
         return self.buffer[index]
 
 
-class BufferWriter(threading.Thread):
-    lock = threading.Lock()
+class BufferThread(threading.Thread):
+    '''
+    class BufferThread works off the items handed to it by put in the background
+
+    put blocks while queue_size items wait, 0 never blocks. The first error is kept and raised by check
+    in the calling thread.
+    '''
 
-    def __init__(self, buffer):
+    def __init__(self, queue_size = 0):
         threading.Thread.__init__(self)
-        self.buffer = buffer
+        self.daemon = True
+
+        self.queue = Queue.Queue(queue_size)
+
+        # exc_info of the first error
+        self.error = None
         return
 
-    def run(self):
-        BufferWriter.lock.acquire()
+    def put(self, item):
+        self.queue.put(item)
 
-        super_length = self.buffer.dset.shape[0]
-        if super_length < self.buffer.id + self.buffer.length:
-            self.buffer.dset.resize(self.buffer.id + self.buffer.length, axis=0)
-            
-        self.buffer.dset[self.buffer.id:self.buffer.id + self.buffer.length] = self.buffer.buffer[0:self.buffer.length]
+    def wait(self):
+        '''waits until every item put so far is done'''
+        self.queue.join()
 
-        self.buffer.buffer = None
-        self.buffer.changed = False
+    def check(self):
+        '''raises the error of the background thread in the calling thread'''
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error[0], error[1], error[2]
 
-        BufferWriter.lock.release()
+    def stop(self):
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+
+            try:
+                self.process(item)
+            except Exception:
+                if self.error is None:
+                    self.error = sys.exc_info()
+
+            self.done(item)
+            self.queue.task_done()
+
+    def process(self, item):
         return
 
-class BufferReader(threading.Thread):
-    def __init__(self, buffer):
-        threading.Thread.__init__(self)
-        self.buffer = buffer
+    def done(self, item):
         return
 
-    def run(self):
-        if not self.buffer.buffer:
-            self.buffer.buffer = [ np.array([-1]) ] * self.buffer.size
+class BufferWriter(BufferThread):
+    '''
+    class BufferWriter writes the buffers handed to it by put in the background
 
-        self.buffer.length = min(self.buffer.size, max(0, self.buffer.dset.shape[0] - self.buffer.id))
-        self.buffer.buffer[0:self.buffer.length] = self.buffer.dset[self.buffer.id:self.buffer.id + self.buffer.length]
-        self.buffer.changed = False
+    afterwards the arrays of the buffers go back into free
+    '''
 
+    def __init__(self, queue_size, free, pending):
+        BufferThread.__init__(self, queue_size)
+        self.free = free
+        self.pending = pending
         return
+
+    def put(self, buffers):
+        for name, buffer in buffers.items():
+            self.pending.add((name, buffer.id))
+        BufferThread.put(self, buffers)
+
+    def process(self, buffers):
+        for buffer in buffers.values():
+            if buffer.changed:
+                buffer.write()
+
+    def done(self, buffers):
+        for name, buffer in buffers.items():
+            self.pending.discard((name, buffer.id))
+            self.free.setdefault(name, []).append(buffer.buffer)
+
+class BufferReader(BufferThread):
+    '''
+    class BufferReader reads the buffers of the blocks handed to it by put in the background
+    '''
+
+    def __init__(self):
+        BufferThread.__init__(self)
+
+        # buffers by block id, read or waiting to be read
+        self.blocks = {}
+        self.loaded = set()
+        self.condition = threading.Condition()
+        return
+
+    def put(self, id, buffers):
+        self.blocks[id] = buffers
+        BufferThread.put(self, id)
+
+    def take(self, id, wait = True):
+        '''returns the buffers of block id once they are read, without wait {} if they are not read yet'''
+        with self.condition:
+            if not wait and id not in self.loaded:
+                return {}
+            while id not in self.loaded:
+                self.condition.wait()
+            self.loaded.discard(id)
+
+        buffers = self.blocks.pop(id)
+        self.check()
+        return buffers
+
+    def process(self, id):
+        for buffer in self.blocks[id].values():
+            buffer.recall()
+
+    def done(self, id):
+        with self.condition:
+            self.loaded.add(id)
+            self.condition.notify_all()
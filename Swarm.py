@@ -0,0 +1,344 @@
+from __future__ import division
+from World import *
+
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+from Config import Config, config
+
+
+def norm_vectors(v):
+    '''norms every vector of a (...,2) array to length 1'''
+    return v / np.linalg.norm(v, axis=-1)[..., np.newaxis]
+
+def rotate_vectors(v, r):
+    '''counter clock wise rotation of every vector of a (...,2) array by the angles r (degree)'''
+    theta = np.radians(r)
+    cos = np.cos(theta)
+    sin = np.sin(theta)
+
+    rotated = np.empty_like(v)
+    rotated[..., 0] = cos * v[..., 0] - sin * v[..., 1]
+    rotated[..., 1] = sin * v[..., 0] + cos * v[..., 1]
+    return rotated
+
+def turn_towards(directions, targets, max_angle):
+    '''turns every direction of a (...,2) array towards its target by at most max_angle (degree), returns them normed'''
+
+    with np.errstate(invalid="ignore"):
+        cos = np.sum(directions * targets, axis=-1) / (np.linalg.norm(directions, axis=-1) * np.linalg.norm(targets, axis=-1))
+    turn_angle = np.degrees(np.arccos(np.clip(cos, -1., 1.)))
+    orientation = np.sign(directions[..., 0] * targets[..., 1] - directions[..., 1] * targets[..., 0])
+
+    #a target which cancels the direction out gives no turn at all
+    turn_angle[np.isnan(turn_angle)] = 0.
+
+    #check if angle exceeds max angle
+    turn_angle = np.minimum(turn_angle, max_angle)
+
+    #rotate the vectors
+    return norm_vectors(rotate_vectors(directions, turn_angle * orientation))
+
+def test_stale_index(engine = "swarm", threads = 0):
+    '''
+    a lone ant speeds up every tick, also while the neighbour index is only updated every second tick
+
+    an ant must not evade its own entry of the index, which is older than its position
+    '''
+    from Ant import Ant
+    test_config = Config(config.to_dict())
+    test_config["schedule"]["neighbour_index"] = 2
+    test_config["ant"]["angle_noise_error"] = 0.
+    test_config["threads"] = threads
+
+    world = World(streams=RandomStreams(1), config=test_config)
+    if engine == "swarm":
+        world.set_swarm(Swarm([[0., 0.]], [[1., 0.]], config=test_config))
+    else:
+        world.add_objects([Ant([0., 0.], [1., 0.], config=test_config)])
+
+    speeds = []
+    for i in range(3):
+        world.tick()
+        speeds.append(float(world.swarm.speeds[0]) if engine == "swarm" else world.world_objects[0].speed)
+
+    acceleration = test_config["ant"]["acceleration"] * world.delta_time
+    assert np.allclose(np.diff(speeds), acceleration), speeds
+    return speeds
+
+def test_threads(thread_counts = (0, 1, 4), n = 300, ticks = 30):
+    '''the same seed gives the same ants with any number of threads, serial ticking included'''
+    test_config = Config(config.to_dict())
+    test_config["thread_chunk_size"] = 64
+
+    generator = np.random.RandomState(3)
+    positions = generator.uniform(-100, 100, (n, 2))
+    directions = generator.uniform(-1, 1, (n, 2))
+
+    results = []
+    for threads in thread_counts:
+        test_config["threads"] = threads
+        world = World(streams=RandomStreams(5), config=test_config)
+        world.set_swarm(Swarm(positions, directions, config=test_config))
+        try:
+            for i in range(ticks):
+                world.tick()
+        finally:
+            world.swarm.close()
+        results.append(world.world_objects_to_numpy())
+
+    for result in results[1:]:
+        assert np.array_equal(results[0], result)
+    return results
+
+
+class Swarm():
+    '''
+    class Swarm holds the state of all ants in contiguous arrays and ticks them at once
+
+    positions and directions are (N,2) arrays, speeds is a (N,) array.
+    The behavior is the same as ticking every Ant object on its own.
+    '''
+
+    def __init__(self, positions, directions, world_instance = None, config = config):
+        self.world = world_instance
+        self.type = "ant"
+
+        self.positions = np.array(positions, dtype=np.float).reshape((-1, 2))
+        #norm the directions to 1
+        self.directions = norm_vectors(np.array(directions, dtype=np.float).reshape((-1, 2)))
+        self.set_parameters(config["ant"])
+        self.speeds = np.full(self.positions.shape[0], self.min_speed, dtype=np.float)
+
+        # threads which tick chunks of the ants in parallel, 0 ticks all ants at once
+        self.threads = config.get("threads", 0)
+        self.chunk_size = config.get("thread_chunk_size", 500)
+        self.pool = None
+
+        # pheromone concentrations at the (left, right) antennas as (2,N) array
+        self.concentrations = None
+
+    def set_parameters(self, ant_config):
+        # speed per second
+        self.max_speed = ant_config["max_speed"]
+        self.min_speed = ant_config["min_speed"]
+        self.max_turn_angle = ant_config["max_turn_angle"]
+        self.acceleration = ant_config["acceleration"]
+
+        self.length = ant_config["length"]
+        self.center_radius = ant_config["center_radius"]
+        self.head_radius = ant_config["head_radius"]
+        self.head_angle = ant_config["head_angle"]
+
+        self.signal_noise = ant_config["angle_noise_error"]
+
+        self.phero_speed_down_treshold = ant_config["phero_speed_down_treshold"]
+
+        # how the antennas read the pheromone map: nearest, bilinear or disk
+        self.antenna_sampling = ant_config.get("antenna_sampling", "nearest")
+
+        # pheromone channels the ants follow and lay, None for the first one
+        self.sense_channel = ant_config.get("sense_channel")
+        self.deposit_channel = ant_config.get("deposit_channel")
+
+    def get_count(self):
+        return self.positions.shape[0]
+
+    def to_dict(self):
+        d = {}
+        d["positions"] = self.positions
+        d["type"] = self.type
+        d["directions"] = self.directions
+        d["speeds"] = self.speeds
+        return d
+
+    def to_numpy(self):
+        arr = np.zeros((3, self.get_count(), 2), dtype=np.float32)
+        arr[0] = self.positions
+        arr[1] = self.directions
+        arr[2] = self.speeds[:, np.newaxis]
+        return arr
+
+    def get_state(self):
+        state = {"positions": self.positions, "directions": self.directions, "speeds": self.speeds}
+        if self.concentrations is not None:
+            state["concentrations"] = self.concentrations
+        return state
+
+    def set_state(self, state):
+        self.positions = np.array(state["positions"], dtype=np.float)
+        self.directions = np.array(state["directions"], dtype=np.float)
+        self.speeds = np.array(state["speeds"], dtype=np.float)
+        self.concentrations = state.get("concentrations")
+
+    def get_left_antenna_positions(self):
+        pos_head = self.get_head_positions()
+        return pos_head + rotate_vectors(self.directions * self.head_radius, np.full(self.get_count(), self.head_angle / 2))
+
+    def get_right_antenna_positions(self):
+        pos_head = self.get_head_positions()
+        return pos_head + rotate_vectors(self.directions * self.head_radius, np.full(self.get_count(), 360 - self.head_angle / 2))
+
+    def get_head_positions(self):
+        return self.positions + self.directions * (self.length / 2)
+
+    def get_tail_positions(self):
+        return self.positions - self.directions * (self.length / 2)
+
+    def get_collision_vectors(self):
+        '''returns the averaged collision vector of every ant and a mask of the ants which have to evade'''
+        # the ants are the indexed objects of the world, they skip themselves and use its cached pairs
+        return self.world.get_collision_vectors(self.positions, self.directions, self.center_radius, self.head_radius, self.head_angle, np.arange(self.get_count()))
+
+    def get_avoiding_vectors(self, directions, collision_vectors, delta):
+        return turn_towards(directions, directions + collision_vectors, self.max_turn_angle * delta)
+
+    def evade_objects(self, delta):
+        '''this is the main collision method, returns a mask of the ants which evaded'''
+
+        collision_vectors, evading = self.get_collision_vectors()
+
+        if np.any(evading):
+            self.directions[evading] = self.get_avoiding_vectors(self.directions[evading], collision_vectors[evading], delta)
+
+        return evading
+
+    def sense(self):
+        '''reads the pheromone concentrations at the left and right antennas of all ants'''
+
+        phero_map = self.world.phero_map
+        c_left = phero_map.get_pheromone_concentrations(self.get_left_antenna_positions(), self.head_radius, self.antenna_sampling, self.sense_channel)
+        c_right = phero_map.get_pheromone_concentrations(self.get_right_antenna_positions(), self.head_radius, self.antenna_sampling, self.sense_channel)
+
+        self.concentrations = np.array([c_left, c_right], dtype=np.float)
+
+    def get_trail_vectors(self, directions, concentrations, noise, delta):
+        '''returns the directions turned to the side with higher pheromone concentration and the absolute turn signal'''
+
+        trail_change = np.zeros(len(directions))
+        c_left, c_right = concentrations
+
+        trailing = c_left + c_right > 0.
+
+        #SIGMOID FUNCTION
+        a = 2 / (1 + np.exp(-4 * (c_left - c_right))) - 1
+        a = np.where(trailing, a + noise, noise)
+        trail_change[trailing] = np.absolute(a[trailing])
+
+        return rotate_vectors(directions, self.max_turn_angle * a * delta), trail_change
+
+    def trail_pheromone(self, delta, mask):
+        '''turns the ants in mask to the side with higher pheromone concentration, returns the absolute turn signal'''
+
+        # one value for every ant like tick_threaded, so the number of threads doesn't change the noise
+        noise = self.world.streams.get("noise").normal(self.get_count()) * self.signal_noise
+        self.directions[mask], trail_change = self.get_trail_vectors(self.directions[mask], self.concentrations[:, mask], noise[mask], delta)
+
+        return trail_change
+
+    def circuit_world(self):
+        shift = self.world.dimensions / 2
+        self.positions = np.mod(self.positions + shift, self.world.dimensions) - shift
+
+    def speed_up(self, delta, mask):
+        self.speeds[mask] = np.minimum(self.speeds[mask] + self.acceleration * delta, self.max_speed)
+
+    def speed_down(self, delta, mask):
+        self.speeds[mask] = np.maximum(self.speeds[mask] - self.acceleration * delta, self.min_speed)
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = ThreadPool(self.threads)
+        return self.pool
+
+    def close(self):
+        '''stops the threads of the pool, the next threaded tick starts a new one'''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def tick_chunk(self, chunk, delta, noise):
+        '''returns the new directions and speeds of the ants in the slice chunk, only reads the state at the start of the tick'''
+
+        positions = self.positions[chunk]
+        directions = self.directions[chunk]
+        speeds = self.speeds[chunk]
+
+        indices = np.arange(self.get_count())[chunk]
+        collision_vectors, evaded = self.world.get_collision_vectors(positions, directions, self.center_radius, self.head_radius, self.head_angle, indices)
+        trailing = ~evaded
+
+        new_directions = np.empty_like(directions)
+        if np.any(evaded):
+            new_directions[evaded] = self.get_avoiding_vectors(directions[evaded], collision_vectors[evaded], delta)
+
+        slow_down = evaded.copy()
+        concentrations = self.concentrations[:, chunk]
+        new_directions[trailing], trail_change = self.get_trail_vectors(directions[trailing], concentrations[:, trailing], noise[trailing], delta)
+        slow_down[trailing] = trail_change >= self.phero_speed_down_treshold
+
+        new_speeds = np.where(slow_down,
+                              np.maximum(speeds - self.acceleration * delta, self.min_speed),
+                              np.minimum(speeds + self.acceleration * delta, self.max_speed))
+
+        return new_directions, new_speeds
+
+    def tick_threaded(self, delta):
+        '''
+        ticks chunks of the ants on the thread pool, numpy and scipy release the GIL in their kernels
+
+        every chunk reads the same state, the pheromone deposits are enqueued before and the new
+        state is merged in chunk order, so the result doesn't depend on the number of threads
+        '''
+
+        count = self.get_count()
+
+        # the noise of all ants is drawn up front, so the chunks don't share the random state
+        noise = self.world.streams.get("noise").normal(count) * self.signal_noise
+
+        chunks = [slice(i, min(i + self.chunk_size, count)) for i in range(0, count, self.chunk_size)]
+        results = self.get_pool().map(lambda chunk: self.tick_chunk(chunk, delta, noise[chunk]), chunks)
+
+        directions = np.empty_like(self.directions)
+        speeds = np.empty_like(self.speeds)
+        for chunk, (d, s) in zip(chunks, results):
+            directions[chunk] = d
+            speeds[chunk] = s
+
+        self.directions = directions
+        self.speeds = speeds
+
+    def tick(self, delta, sense = True):
+        '''
+        runs the movement logic of Ant.tick for all ants at once
+
+        sense = False moves with the concentrations of the last call of sense
+        '''
+
+        if sense or self.concentrations is None or self.concentrations.shape[1] != self.get_count():
+            self.sense()
+
+        #set pheromone concentration
+        self.world.phero_map.add_pheromone_concentrations(self.get_tail_positions(), 100. * delta * self.speeds, self.deposit_channel)
+
+        if self.threads > 0:
+            self.tick_threaded(delta)
+        else:
+            self.tick_serial(delta)
+
+        self.positions += self.directions * self.speeds[:, np.newaxis] * self.world.delta_time
+
+        #wrap around the edges of the world
+        self.circuit_world()
+
+    def tick_serial(self, delta):
+        '''ticks all ants at once, every ant only reads the state at the start of the tick like tick_threaded'''
+        evaded = self.evade_objects(delta)
+        trailing = ~evaded
+
+        slow_down = evaded.copy()
+        slow_down[trailing] = self.trail_pheromone(delta, trailing) >= self.phero_speed_down_treshold
+
+        self.speed_down(delta, slow_down)
+        self.speed_up(delta, ~slow_down)
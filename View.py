@@ -13,7 +13,6 @@ import time
 import numpy as np
 import pyglet
 
-import matplotlib.pyplot as plt
 
 import pyglet.window.key as key
 
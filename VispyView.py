@@ -5,7 +5,6 @@ from vispy import gloo
 from vispy.util.transforms import perspective, translate, rotate
 
 from Storage import Storage
-from Simulator import Simulator
 
 import Global as g
 
@@ -1,10 +1,12 @@
 from __future__ import division
 import numpy as np
+import threading
 from Diffusion import *
-from scipy.spatial import cKDTree
+from SpatialIndex import *
+from Scheduler import *
+from RandomStreams import *
 
-import yaml
-config = yaml.load(open("config.yml"))
+from Config import config
 
 ### helper functions ###
 
@@ -55,6 +57,36 @@ def rotate_vector(v, r):
 
     return np.dot(rotMatrix, v)
 
+def get_weighted_collision_vectors(rows, diff, directions, count, center_radius, head_radius, check_angle):
+    '''averages the unit vectors diff of the neighbour pairs into a collision vector for each of count objects
+
+    rows[k] is the object of the pair k, directions[k] its direction. A neighbour in the center range and
+    a neighbour in range and angle of the head are averaged, one in both counts twice. The radii and the
+    angle can also be arrays with a value per pair. Also returns a mask of the objects with neighbours in range.
+    '''
+
+    collision_vectors = np.zeros((count, diff.shape[1]), dtype=np.float)
+    distance = np.linalg.norm(diff, axis=1)
+
+    in_center = distance <= center_radius * 2
+
+    cos = -np.sum(directions * diff, axis=1) / (np.linalg.norm(directions, axis=1) * distance)
+    angle = np.degrees(np.arccos(np.clip(cos, -1., 1.)))
+    in_top = (distance <= head_radius * 2) & (angle <= check_angle / 2)
+
+    weights = in_center.astype(np.float) + in_top
+    hits = np.bincount(rows, weights=weights, minlength=count)
+
+    unit = diff / distance[:, np.newaxis]
+
+    for j in range(diff.shape[1]):
+        collision_vectors[:, j] = np.bincount(rows, weights=unit[:, j] * weights, minlength=count)
+
+    colliding = hits > 0
+    collision_vectors[colliding] /= hits[colliding][:, np.newaxis]
+
+    return collision_vectors, colliding
+
 
 class World():
     '''
@@ -62,19 +94,38 @@ class World():
     It can give back distances between objects or return a set of objects in a given range
     '''
 
-    def __init__(self):
+    def __init__(self, phero_map = None, streams = None, config = config):
+        #settings of the world and of what it creates, e.g. a Config of a recording
+        self.config = config
+
         self.dimensions = np.array(config["world_dimension"])
         self.world_objects = []
 
-        #kd tree for faster search
-        self.kdtree = None
+        #swarm which holds all ants as arrays, replaces the ant objects if set
+        self.swarm = None
+
+        #spatial index for faster search
+        self.neighbour_index = self.create_neighbour_index()
+        #neighbour pairs of the index by radius
+        self.neighbour_pairs = {}
+        self.neighbour_lock = threading.Lock()
 
         #the pheromone concentration map
-        self.phero_map = PheromoneMap()
+        if phero_map is None:
+            phero_map = create_pheromone_map(config=config)
+        self.phero_map = phero_map
 
         #time which passes between two ticks
         self.delta_time = config["delta"]
 
+        #seeded random streams, the same seed gives the same simulation
+        if streams is None:
+            streams = RandomStreams()
+        self.streams = streams
+
+        #the stages of a tick, each at the rate of config.yml
+        self.scheduler = self.create_scheduler()
+
     def to_dict(self):
         d = {}
         d["dimensions"] = self.dimensions
@@ -85,11 +136,16 @@ class World():
 
     def world_objects_to_dict(self, type=None):
         objects = []
+        if self.swarm:
+            objects.append(self.swarm.to_dict())
         for o in self.world_objects:
             objects.append(o.to_dict())
         return objects
 
     def world_objects_to_numpy(self, type=None):
+        if self.swarm:
+            return self.swarm.to_numpy()
+
         arr = np.zeros((3, len(self.world_objects), 2), dtype=np.float32)
         for i in range(len(self.world_objects)):
             arr[0,i,:] = self.world_objects[i].position
@@ -98,31 +154,80 @@ class World():
         return arr
 
 
-    def update_kdtree(self):
-        #construct kdtree
-        point_list = []
+    def get_state(self):
+        '''returns everything which changes during a simulation as nested dict of arrays'''
+        state = {"delta_time": self.delta_time,
+                 "scheduler": self.scheduler.get_state(),
+                 "neighbour_index": self.neighbour_index.get_state(),
+                 "phero_map": self.phero_map.get_state(),
+                 "streams": self.streams.get_state()}
+
+        if self.swarm:
+            state["swarm"] = self.swarm.get_state()
+
+        if self.world_objects:
+            state["objects"] = {"positions": np.array([o.position for o in self.world_objects]),
+                                "directions": np.array([o.direction for o in self.world_objects]),
+                                "speeds": np.array([o.speed for o in self.world_objects], dtype=np.float)}
+        return state
+
+    def set_state(self, state):
+        '''continues from a state of get_state, the world has to hold as many objects as back then'''
+        self.delta_time = float(state["delta_time"])
+        self.scheduler.set_state(state["scheduler"])
+        self.neighbour_index.set_state(state["neighbour_index"])
+        self.reset_neighbour_cache()
+        self.phero_map.set_state(state["phero_map"])
+        self.streams.set_state(state["streams"])
+
+        if "swarm" in state:
+            self.swarm.set_state(state["swarm"])
+
+        if "objects" in state:
+            objects = state["objects"]
+            for i, o in enumerate(self.world_objects):
+                o.position = np.array(objects["positions"][i], dtype=np.float)
+                o.direction = np.array(objects["directions"][i], dtype=np.float)
+                o.speed = objects["speeds"][i]
+
+    def get_positions(self):
+        '''returns the positions of all objects as (N,2) array'''
+        if self.swarm:
+            return self.swarm.positions
+
+        return np.array([o.position for o in self.world_objects], dtype=np.float).reshape((-1, 2))
+
+    def create_neighbour_index(self):
+        config = self.config
+        index_type = config.get("spatial_index", "kdtree")
+        skin = config.get("neighbour_skin", 0.)
+
+        # the largest collision range of an ant
+        radius = max(config["ant"]["center_radius"], config["ant"]["head_radius"]) * 2
+
+        if index_type == "grid":
+            index = CellList(self.dimensions, radius + skin)
+        else:
+            index = PeriodicKDTree(self.dimensions)
+
+        if skin > 0:
+            return VerletList(index, radius, skin)
+        return index
 
-        shift = self.dimensions / 2.
-        border = 10.
-        for o in self.world_objects:
-            point_list.append(o.position)
-
-            # add object onto the opposite side but outside world
-            for j in range(self.dimensions.shape[0]):
-                if o.position[j] >= shift[j] - border:
-                    col_pos = o.position.copy()
-                    d = shift[j] - col_pos[j]
-                    col_pos[j] = -shift[j] - d
-                    point_list.append(col_pos)
-                elif o.position[j] < -shift[j] + border:
-                    col_pos = o.position.copy()
-                    d = col_pos[j] + shift[j]
-                    col_pos[j] = shift[j] - d
-                    point_list.append(col_pos)
-
-        self.kdtree = cKDTree(np.array(point_list, dtype=np.float), 50)
+    def update_neighbour_index(self):
+        self.neighbour_index.update(self.get_positions())
+        self.reset_neighbour_cache()
+
+    def reset_neighbour_cache(self):
+        '''forgets the neighbour pairs of the last index, the objects learn their row in the new one'''
+        self.neighbour_pairs = {}
+
+        for i, o in enumerate(self.world_objects):
+            o.index = i
 
     def get_ant_count(self):
+        if self.swarm:
+            return self.swarm.get_count()
         return len(self.world_objects)
 
     def get_objects_in_range(self, pos, radius):
@@ -138,16 +243,80 @@ class World():
 
         return in_range
 
-    def get_positions_in_range_kd(self, pos, radius):
-        indices = self.kdtree.query_ball_point(pos, radius * 2)
+    def get_neighbours(self, positions, radius, indices = None):
+        '''returns the neighbours of every position within radius as (rows, cols, diff)
+
+        cols are the indices of the neighbours, diff is the shortest vector from neighbour cols[k]
+        to positions[rows[k]] across the world borders. indices are the indices of the objects at
+        positions in the neighbour index, the entries of the objects themselves are skipped.
+        '''
+
+        rows, cols = self.neighbour_index.query(positions, radius)
+
+        if indices is not None:
+            # by index, the entry of an object is older than its position when the index is reused
+            others = np.asarray(indices)[rows] != cols
+            rows, cols = rows[others], cols[others]
+
+        diff = self.neighbour_index.get_difference(positions[rows], self.neighbour_index.positions[cols])
+
+        return self.skip_coincident(rows, cols, diff)
+
+    def get_object_neighbours(self, radius, indices):
+        '''returns the neighbours of the indexed objects indices within radius as (rows, cols, diff)
+
+        like get_neighbours for objects at their indexed positions, rows index into indices.
+        The pairs of the index are only queried once per index update.
+        '''
+
+        rows, cols = self.get_neighbour_pairs(radius)
+
+        if len(indices) > 0 and indices[-1] - indices[0] == len(indices) - 1 and np.all(np.diff(indices) == 1):
+            # a range of objects, e.g. a chunk of the swarm, is a range of the sorted pairs
+            first, last = np.searchsorted(rows, [indices[0], indices[-1] + 1])
+            rows, cols = rows[first:last] - indices[0], cols[first:last]
+        else:
+            # the pairs of the queried objects, their rows become positions in indices
+            local = np.full(len(self.neighbour_index.positions), -1, dtype=np.int)
+            local[indices] = np.arange(len(indices))
+            selected = local[rows] >= 0
+            rows, cols = local[rows[selected]], cols[selected]
+
+        positions = self.neighbour_index.positions
+        diff = self.neighbour_index.get_difference(positions[indices][rows], positions[cols])
+
+        return self.skip_coincident(rows, cols, diff)
+
+    def get_neighbour_pairs(self, radius):
+        '''returns the pairs of indexed objects within radius sorted by rows, once per index update'''
+        # the chunks of a threaded swarm ask at the same time, only the first one queries
+        with self.neighbour_lock:
+            if radius not in self.neighbour_pairs:
+                rows, cols = self.neighbour_index.query_pairs(radius)
+                order = np.argsort(rows, kind="mergesort")
+                self.neighbour_pairs[radius] = rows[order], cols[order]
+
+            return self.neighbour_pairs[radius]
 
-        new_indices = []
+    def is_indexed(self, positions, indices):
+        '''true if the objects indices are in the neighbour index at positions'''
+        indexed = self.neighbour_index.positions
+        if len(indices) > 0 and np.max(indices) >= len(indexed):
+            return False
+        return np.array_equal(positions, indexed[indices])
 
-        for i in indices:
-            if not np.array_equal(self.kdtree.data[i], pos):
-                new_indices.append(i)
+    def skip_coincident(self, rows, cols, diff):
+        # objects at the very same position have no direction to each other
+        apart = np.any(diff != 0, axis=1)
+        return rows[apart], cols[apart], diff[apart]
 
-        return self.kdtree.data[new_indices]
+    def get_positions_in_range_kd(self, pos, radius, index = None):
+        '''returns the positions of the indexed objects in range of pos, except the object index'''
+        indices = None if index is None else [index]
+        rows, cols, diff = self.get_neighbours(np.array(pos, dtype=np.float).reshape((1, 2)), radius * 2, indices)
+
+        # image of every neighbour next to pos
+        return pos - diff
 
 
     def get_objects_in_range_and_radius(self, pos, dir, radius, check_angle):
@@ -165,8 +334,8 @@ class World():
 
         return in_angle
 
-    def get_positions_in_range_and_radius_kd(self, pos2, dir, radius, check_angle):
-        in_range = self.get_positions_in_range_kd(pos2, radius)
+    def get_positions_in_range_and_radius_kd(self, pos2, dir, radius, check_angle, index = None):
+        in_range = self.get_positions_in_range_kd(pos2, radius, index)
         in_angle = [];
 
         for pos1 in in_range:
@@ -178,6 +347,31 @@ class World():
 
         return np.array(in_angle)
 
+    def get_collision_vectors(self, positions, directions, center_radius, head_radius, check_angle, indices = None):
+        '''returns the weighted collision vector for every position in one neighbour query
+
+        positions and directions are (N,2) arrays. Objects in the center range and objects
+        in range and angle of the head are averaged, an object in both counts twice.
+        Also returns a mask of the positions which have objects in range.
+
+        indices are the indices of the objects at positions in the neighbour index, they don't collide
+        with themselves. While they are at their indexed positions the cached neighbour pairs are used.
+        positions = None queries all indexed objects.
+        '''
+
+        radius = max(center_radius, head_radius) * 2
+
+        if positions is None:
+            positions = self.neighbour_index.positions
+            indices = np.arange(len(positions))
+
+        if indices is not None and self.is_indexed(positions, indices):
+            rows, cols, diff = self.get_object_neighbours(radius, indices)
+        else:
+            rows, cols, diff = self.get_neighbours(positions, radius, indices)
+
+        return get_weighted_collision_vectors(rows, diff, directions[rows], len(positions), center_radius, head_radius, check_angle)
+
 
     def get_objects(self, type = "all"):
         '''returns all objects
@@ -202,19 +396,53 @@ class World():
             o.world = self
             self.add_object(o)
 
+    def set_swarm(self, swarm):
+        #set world_instance to self
+        swarm.world = self
+
+        self.swarm = swarm
+
     def remove_all_objects(self):
         self.world_objects = []
-
-    def tick(self):
+        self.swarm = None
+
+    def create_scheduler(self):
+        scheduler = Scheduler(self.config)
+        scheduler.add_stage("neighbour_index", self.index_objects)
+        scheduler.add_stage("sensing", self.sense)
+        # the ants move every tick
+        scheduler.add_stage("movement", self.move, 1)
+        scheduler.add_stage("deposition", self.deposit)
+        scheduler.add_stage("diffusion", self.diffuse)
+        return scheduler
+
+    def index_objects(self, elapsed):
         # update kdtree for fast neighbour lookup
-        self.update_kdtree()
+        self.update_neighbour_index()
+
+    def sense(self, elapsed):
+        # the swarm moves with these concentrations until the next sensing
+        if self.swarm:
+            self.swarm.sense()
+
+    def move(self, elapsed):
+        # tick all ants at once
+        if self.swarm:
+            self.swarm.tick(elapsed, sense = False)
 
         # tick objects
         for o in self.world_objects:
-            o.tick(self.delta_time)
+            o.tick(elapsed)
 
-        #update pheromap
-        self.phero_map.tick(self.delta_time)
+    def deposit(self, elapsed):
+        self.phero_map.apply_changes()
+
+    def diffuse(self, elapsed):
+        # convolve to blur pheromone, the map keeps its own diffusion clock
+        self.phero_map.diffuse(self.phero_map.get_steps(elapsed))
+
+    def tick(self):
+        self.scheduler.tick(self.delta_time)
 
 
 class WorldObject():
@@ -230,6 +458,9 @@ class WorldObject():
         self.type = None
         self.world = world_instance
 
+        #row of the object in the neighbour index of the world
+        self.index = None
+
     def to_dict(self):
         d = {}
         d["position"] = self.position